@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Peak memory of a dashboard rerun for large date ranges, without DB:
+rows are generated and served by the DatasetCache like in the app.
+Every case runs in its own process so the peak RSS is not shared, from the
+repo root
+    python benchmarks/dashboard_memory.py --days 7 30 90 --rows-per-day 20000
+
+`legacy` is the previous processing (float64, python strings, tz and rounding
+applied on a copy), `compact` the current one
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from data_cache import DatasetCache, prepare_for_display  # noqa: E402
+
+
+TZ = 'Europe/Berlin'
+
+
+def synthetic_loader(rows_per_day: int):
+    headlines = [f'headline number {i} about something that happened today' for i in range(5000)]
+
+    def load(start, end, after):
+        n_days = max((end - start) // pd.Timedelta(days=1), 1)
+        timestamps = start + pd.to_timedelta(
+            np.linspace(0, n_days * 86400, n_days * rows_per_day, endpoint=False), unit='s')
+        rng = np.random.default_rng(int(start.timestamp()))
+        df = pd.DataFrame({'timestamp': timestamps.tz_localize(None),
+                           'sentiment_score': rng.uniform(-1, 1, len(timestamps)),
+                           'text': [headlines[i % len(headlines)] for i in range(len(timestamps))]})
+        if after is not None:
+            df = df[df['timestamp'] > after.tz_localize(None)]
+        return df
+    return load
+
+
+def legacy_rerun(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.astype({'sentiment_score': 'float64', 'text': 'object'})
+    df['timestamp'] = df['timestamp'].dt.tz_convert(TZ)
+    df['sentiment_score'] = df['sentiment_score'].round(2)
+    return df
+
+
+def compact_rerun(df: pd.DataFrame) -> pd.DataFrame:
+    return prepare_for_display(df, TZ)
+
+
+def rss_mb() -> float:
+    # ru_maxrss is in KB on linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def run_case(mode: str, days: int, rows_per_day: int, reruns: int) -> None:
+    cache = DatasetCache(synthetic_loader(rows_per_day), max_bytes=2 ** 40)
+    start, end = '2021-01-01', str((pd.Timestamp('2021-01-01') + pd.Timedelta(days=days)).date())
+    rerun = legacy_rerun if mode == 'legacy' else compact_rerun
+    # the first read fills the cache, the reruns are what a user sees afterwards
+    df = cache.get_range(start, end)
+    cache_mb = cache.nbytes / 2 ** 20
+    rss_before = rss_mb()
+    tracemalloc.start()
+    peaks = []
+    for _ in range(reruns):
+        tracemalloc.reset_peak()
+        shown = rerun(cache.get_range(start, end))
+        peaks.append(tracemalloc.get_traced_memory()[1] / 2 ** 20)
+        del shown
+    tracemalloc.stop()
+    print(f'{mode:8} {days:4d} days {len(df):10d} rows  cache {cache_mb:8.1f} MB  '
+          f'rerun peak {max(peaks):8.1f} MB  process peak RSS {rss_mb():8.1f} MB '
+          f'(+{rss_mb() - rss_before:.1f} during reruns)')
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='peak memory of the dashboard reruns')
+    arg_parser.add_argument('--days', type=int, nargs='+', default=[7, 30, 90])
+    arg_parser.add_argument('--rows-per-day', type=int, default=20000)
+    arg_parser.add_argument('--reruns', type=int, default=5)
+    arg_parser.add_argument('--mode', choices=['legacy', 'compact'], default=None,
+                            help='run a single case in this process')
+    args = arg_parser.parse_args()
+    if args.mode:
+        for days in args.days:
+            run_case(args.mode, days, args.rows_per_day, args.reruns)
+        return
+    for days in args.days:
+        for mode in ('legacy', 'compact'):
+            subprocess.run([sys.executable, __file__, '--mode', mode, '--days', str(days),
+                            '--rows-per-day', str(args.rows_per_day),
+                            '--reruns', str(args.reruns)], check=True)
+
+
+if __name__ == "__main__":
+    main()
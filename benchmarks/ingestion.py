@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the ingestion and dashboard paths, from the repo root
+    python benchmarks/ingestion.py --records 10 1000 100000 --output run.json
+    python benchmarks/ingestion.py --records 10 1000 100000 --compare run.json
+
+Synthetic Guardian and Twitter payloads (or recorded ones, --recorded) are
+generated chunk by chunk so even 1M records fit in memory, then go through
+every stage of the lambda: filter new posts, extract, score, serialize,
+S3 upload and DB insert, one stage at a time and then end to end with the
+concurrent sinks of the pipeline. The dashboard cache and processing are
+measured on a table of the same size.
+
+S3 is the endpoint in S3_ENDPOINT_URL (i.e. minio or `moto_server`) or moto
+in process when it is installed, otherwise the upload is skipped.
+The DB stage runs only if BENCHMARK_DSN is set (i.e. postgresql://localhost/bench),
+it writes in bench_* tables. For each stage the throughput and the
+percentiles of the time per chunk are printed and saved as json, --compare
+exits with 1 if a stage got slower than --threshold
+"""
+
+import argparse
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import pytz
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lambda_ import archive, db, lambda_function, lambda_function_guardian, pipeline  # noqa: E402
+from lambda_.watermark import Watermark  # noqa: E402
+from data_cache import DatasetCache, prepare_for_display  # noqa: E402
+from dashboard_memory import synthetic_loader  # noqa: E402
+
+
+BUCKET = 'benchmark'
+START = datetime(2021, 11, 1, tzinfo=pytz.UTC)
+WORDS = ('market stocks fall rise crisis win great terrible storm election vote '
+         'climate deal talks growth fear hope record loss strong weak attack peace').split()
+
+SOURCES = {
+    'guardian': dict(module=lambda_function_guardian,
+                     table_name='bench_guardian_posts',
+                     ddl='author varchar(50), timestamp timestamp with time zone, '
+                         'text varchar(300), sentiment_score double precision, '
+                         'PRIMARY KEY(author, timestamp)'),
+    'twitter': dict(module=lambda_function,
+                    table_name='bench_tweets',
+                    ddl='author varchar(50), timestamp timestamp with time zone, '
+                        'text varchar(300), sentiment_score double precision, '
+                        'PRIMARY KEY(author, timestamp)'),
+}
+
+
+def guardian_post(i: int, when: datetime, text: str) -> dict:
+    return {'id': f'world/2021/nov/{i:08d}', 'type': 'article', 'sectionId': 'world',
+            'sectionName': 'World news', 'webPublicationDate': when.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'webTitle': text, 'webUrl': f'https://www.theguardian.com/world/2021/nov/{i:08d}',
+            'apiUrl': f'https://content.guardianapis.com/world/2021/nov/{i:08d}',
+            'isHosted': False, 'pillarId': 'pillar/news', 'pillarName': 'News'}
+
+
+def tweet(i: int, when: datetime, text: str) -> dict:
+    return {'created_at': when.strftime('%a %b %d %H:%M:%S +0000 %Y'),
+            'id': 1455000000000000000 + i, 'id_str': str(1455000000000000000 + i),
+            'text': text, 'truncated': False, 'lang': 'en',
+            'user': {'id_str': '1652541', 'screen_name': 'reuters', 'name': 'Reuters'},
+            'retweet_count': i % 50, 'favorite_count': i % 200}
+
+
+def recorded_post(source: str, post: dict, i: int, when: datetime) -> dict:
+    # a recorded post repeated with a new id and date so that every record is new
+    post = dict(post)
+    if source == 'guardian':
+        post['id'] = f'{post["id"]}-{i}'
+        post['webPublicationDate'] = when.strftime('%Y-%m-%dT%H:%M:%SZ')
+    else:
+        post['id_str'] = str(1455000000000000000 + i)
+        post['created_at'] = when.strftime('%a %b %d %H:%M:%S +0000 %Y')
+    return post
+
+
+def generate_posts(source: str, records: int, chunk_size: int,
+                   recorded: Optional[List[dict]] = None,
+                   distinct_texts: int = 5000, seed: int = 0) -> Iterator[List[dict]]:
+    '''
+    chunks of raw API posts one second apart, the same for a given seed
+    '''
+    rng = random.Random(seed)
+    texts = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))).capitalize()
+             for _ in range(distinct_texts)]
+    make = guardian_post if source == 'guardian' else tweet
+    for first in range(0, records, chunk_size):
+        chunk = []
+        for i in range(first, min(first + chunk_size, records)):
+            when = START + timedelta(seconds=i)
+            if recorded:
+                chunk.append(recorded_post(source, recorded[i % len(recorded)], i, when))
+            else:
+                chunk.append(make(i, when, texts[rng.randrange(distinct_texts)]))
+        yield chunk
+
+
+def summarize(records: int, chunk_seconds: List[float], wall_seconds: Optional[float] = None) -> dict:
+    seconds = wall_seconds if wall_seconds is not None else sum(chunk_seconds)
+    ms = np.array(chunk_seconds) * 1000
+    return dict(records=records, seconds=round(seconds, 4),
+                records_per_s=round(records / seconds, 1) if seconds else None,
+                p50_ms=round(float(np.percentile(ms, 50)), 3),
+                p90_ms=round(float(np.percentile(ms, 90)), 3),
+                p99_ms=round(float(np.percentile(ms, 99)), 3),
+                max_ms=round(float(ms.max()), 3))
+
+
+class Timer:
+    def __init__(self):
+        self.seconds: Dict[str, List[float]] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        yield
+        self.seconds.setdefault(name, []).append(time.perf_counter() - started)
+
+
+@contextmanager
+def local_s3() -> Iterator[bool]:
+    '''
+    True when a S3 stand-in is available, the bucket is created in it
+    '''
+    mock = None
+    if not os.environ.get('S3_ENDPOINT_URL'):
+        try:
+            import moto
+        except ImportError:
+            print('no S3_ENDPOINT_URL and moto is not installed: the S3 stages are skipped')
+            yield False
+            return
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        mock = moto.mock_aws() if hasattr(moto, 'mock_aws') else moto.mock_s3()
+        mock.start()
+    archive.get_s3_client.cache_clear()
+    client = archive.get_s3_client()
+    if BUCKET not in [bucket['Name'] for bucket in client.list_buckets()['Buckets']]:
+        client.create_bucket(Bucket=BUCKET)
+    try:
+        yield True
+    finally:
+        if mock is not None:
+            mock.stop()
+        archive.get_s3_client.cache_clear()
+
+
+def prepare_db(dsn: Optional[str]) -> bool:
+    if not dsn:
+        print('BENCHMARK_DSN is not set: the DB stages are skipped')
+        return False
+    import psycopg2
+
+    db.pool = db.ConnectionPool(lambda: psycopg2.connect(dsn), max_size=4)
+    with db.db_connection() as conn:
+        with conn.cursor() as cur:
+            for config in SOURCES.values():
+                cur.execute(f'DROP TABLE IF EXISTS {config["table_name"]}; '
+                            f'CREATE TABLE {config["table_name"]}({config["ddl"]})')
+        conn.commit()
+    return True
+
+
+def truncate(table_name: str) -> None:
+    with db.db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f'TRUNCATE {table_name}')
+        conn.commit()
+
+
+def bench_stages(source: str, records: int, chunk_size: int, recorded: Optional[List[dict]],
+                 use_s3: bool, use_db: bool) -> Dict[str, dict]:
+    '''
+    every stage on its own, one chunk at a time
+    '''
+    module = SOURCES[source]['module']
+    table_name = SOURCES[source]['table_name']
+    watermark = Watermark(START - timedelta(days=1), '0')
+    archive_sink = pipeline.ArchiveSink(BUCKET, table_name) if use_s3 else None
+    db_sink = pipeline.DbSink(table_name) if use_db else None
+    if use_db:
+        truncate(table_name)
+    pipeline.engine.clear()
+    timer = Timer()
+    for chunk in generate_posts(source, records, chunk_size, recorded):
+        with timer.stage('filter'):
+            chunk = [post for post in chunk if module.is_new(post, watermark)]
+        with timer.stage('extract'):
+            rows = [module.extract_fields(post) for post in chunk]
+        with timer.stage('score'):
+            pipeline.add_sentiment_scores(rows)
+        with timer.stage('serialize'):
+            archive.serialize_records(pipeline.convert_timestamp_to_int(row) for row in rows)
+        if archive_sink:
+            with timer.stage('s3_upload'):
+                archive_sink.write(rows)
+        if db_sink:
+            with timer.stage('db_insert'):
+                db_sink.write(rows)
+    return {stage: summarize(records, seconds) for stage, seconds in timer.seconds.items()}
+
+
+def bench_end_to_end(source: str, records: int, chunk_size: int, recorded: Optional[List[dict]],
+                     use_s3: bool, use_db: bool) -> dict:
+    '''
+    the streaming path of the lambda, the sinks write while the next chunks are processed
+    '''
+    module = SOURCES[source]['module']
+    table_name = SOURCES[source]['table_name']
+    watermark = Watermark(START - timedelta(days=1), '0')
+    sinks = []
+    if use_s3:
+        sinks.append(pipeline.ArchiveSink(BUCKET, table_name))
+    if use_db:
+        truncate(table_name)
+        sinks.append(pipeline.DbSink(table_name))
+    runners = [pipeline.SinkRunner(sink, table_name, BUCKET) for sink in sinks]
+    pipeline.engine.clear()
+    posts = (post for chunk in generate_posts(source, records, chunk_size, recorded)
+             for post in chunk if module.is_new(post, watermark))
+    chunk_seconds = []
+    started = last = time.perf_counter()
+    stages = pipeline.score_stage(pipeline.extract_stage(pipeline.fetch_stage(posts, chunk_size),
+                                                         module.extract_fields))
+    for chunk in stages:
+        for runner in runners:
+            runner.submit(chunk)
+        now = time.perf_counter()
+        chunk_seconds.append(now - last)
+        last = now
+    for runner in runners:
+        runner.close()
+    return summarize(records, chunk_seconds, wall_seconds=time.perf_counter() - started)
+
+
+def bench_dashboard(records: int, repeat: int) -> Dict[str, dict]:
+    '''
+    a week of `records` rows read through the cache and prepared for the table
+    '''
+    cache = DatasetCache(synthetic_loader(max(records // 7, 1)), max_bytes=2 ** 40)
+    timer = Timer()
+    with timer.stage('dashboard_first_load'):
+        cache.get_range('2021-01-01', '2021-01-07')
+    for _ in range(repeat):
+        with timer.stage('dashboard_get_range'):
+            df = cache.get_range('2021-01-01', '2021-01-07')
+        with timer.stage('dashboard_process'):
+            prepare_for_display(df, 'Europe/Berlin')
+    return {stage: summarize(len(df), seconds) for stage, seconds in timer.seconds.items()}
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(records_list: List[int], sources: List[str], chunk_size: int, repeat: int,
+        recorded: Dict[str, List[dict]], dsn: Optional[str]) -> dict:
+    use_db = prepare_db(dsn)
+    results = {}
+    with local_s3() as use_s3:
+        for records in records_list:
+            for source in sources:
+                name = f'{source}/{records}'
+                print(f'{name} ...', flush=True)
+                results[name] = bench_stages(source, records, chunk_size, recorded.get(source),
+                                             use_s3, use_db)
+                results[name]['end_to_end'] = bench_end_to_end(source, records, chunk_size,
+                                                               recorded.get(source), use_s3, use_db)
+            results[f'dashboard/{records}'] = bench_dashboard(records, repeat)
+    return dict(meta=dict(created_at=datetime.now(tz=pytz.UTC).isoformat(), commit=_git_commit(),
+                          python=platform.python_version(), machine=platform.platform(),
+                          chunk_size=chunk_size, s3=use_s3, db=use_db),
+                results=results)
+
+
+def print_results(report: dict) -> None:
+    for name, stages in report['results'].items():
+        print(name)
+        for stage, result in stages.items():
+            print(f'    {stage:22} {result["records_per_s"] or 0:>12,.0f} rec/s '
+                  f'p50 {result["p50_ms"]:>9.3f} ms  p90 {result["p90_ms"]:>9.3f} ms  '
+                  f'p99 {result["p99_ms"]:>9.3f} ms')
+
+
+def compare(baseline: dict, report: dict, threshold: float) -> bool:
+    '''
+    print the throughput change of every stage found in both runs,
+    False if one of them is slower than the baseline by more than `threshold`
+    '''
+    ok = True
+    print(f'compared with {baseline["meta"].get("commit")} of {baseline["meta"].get("created_at")}')
+    for name, stages in report['results'].items():
+        for stage, result in stages.items():
+            before = baseline['results'].get(name, {}).get(stage)
+            if not before or not before['records_per_s'] or not result['records_per_s']:
+                continue
+            change = result['records_per_s'] / before['records_per_s'] - 1
+            flag = ''
+            if change < -threshold:
+                flag = '  REGRESSION'
+                ok = False
+            print(f'{name:20} {stage:22} {before["records_per_s"]:>12,.0f} -> '
+                  f'{result["records_per_s"]:>12,.0f} rec/s {change:>+8.1%}{flag}')
+    return ok
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='offline benchmark of the ingestion and dashboard')
+    arg_parser.add_argument('--records', type=int, nargs='+', default=[10, 1000, 100000])
+    arg_parser.add_argument('--sources', nargs='+', choices=list(SOURCES), default=list(SOURCES))
+    arg_parser.add_argument('--chunk-size', type=int, default=pipeline.DEFAULT_CHUNK_SIZE)
+    arg_parser.add_argument('--repeat', type=int, default=5,
+                            help='runs of the dashboard stages')
+    arg_parser.add_argument('--recorded', nargs='*', default=[], metavar='SOURCE=FILE',
+                            help='i.e. guardian=results.json, a json list of posts saved from the API')
+    arg_parser.add_argument('--output', help='save the results in this json file')
+    arg_parser.add_argument('--compare', help='json file of a previous run')
+    arg_parser.add_argument('--threshold', type=float, default=0.1,
+                            help='slowdown flagged as regression by --compare (default 10%%)')
+    args = arg_parser.parse_args()
+
+    recorded = {}
+    for item in args.recorded:
+        source, path = item.split('=', 1)
+        with open(path) as fin:
+            recorded[source] = json.load(fin)
+    report = run(args.records, args.sources, args.chunk_size, args.repeat, recorded,
+                 dsn=os.environ.get('BENCHMARK_DSN'))
+    print_results(report)
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(report, fout, indent=1)
+        print(f'results saved in {args.output}')
+    if args.compare:
+        with open(args.compare) as fin:
+            if not compare(json.load(fin), report, args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
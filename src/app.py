@@ -5,58 +5,182 @@ Streamlit dashboard showing tweets and their trend!
 """
 
 import datetime
+import os
+import time
+from typing import Optional, Tuple
 
 import numpy as np
 import pandas as pd
+import psycopg2.errors
 import streamlit as st
 from st_aggrid import AgGrid, JsCode, GridOptionsBuilder
 
-from lambda_.lambda_function import get_db_connection
+from data_cache import DatasetCache, compact_frame, prepare_for_display
+from queries import DISPLAY_COLUMNS, build_page_query, build_query, where_clause
+from lambda_.db import db_connection
+from lambda_.metrics import thread_metrics
+from lambda_.rollups import ROLLUP_TABLE, choose_resolution, downsample, read_rollups
 
 
-@st.cache(suppress_st_warning=True)
+# more points than this cannot be seen on the chart anyway
+MAX_CHART_POINTS = 500
+# with a keyword, ranges estimated below this number of rows are counted exactly
+EXACT_COUNT_LIMIT = 10000
+
+
+def _load_rows(start: pd.Timestamp,
+               end: pd.Timestamp,
+               after: Optional[pd.Timestamp] = None,
+               table_name: str = 'tweets_analytics') -> pd.DataFrame:
+    # rows read by the dataset cache, a whole day or only its newest rows
+    sql = f"""select {', '.join(DISPLAY_COLUMNS)} from {table_name}
+              where timestamp >= %s and timestamp < %s"""
+    params = [start.to_pydatetime(), end.to_pydatetime()]
+    if after is not None:
+        sql += " and timestamp > %s"
+        params.append(after.to_pydatetime())
+    sql += " order by timestamp"
+    thread_metrics().count('dashboard_db_queries')
+    with db_connection() as conn, thread_metrics().timer('dashboard_cache_load'):
+        return pd.read_sql_query(sql, conn, params=params)
+
+
+@st.experimental_singleton
+def get_dataset_cache() -> DatasetCache:
+    # one cache shared by all the sessions of the dashboard
+    return DatasetCache(_load_rows,
+                        max_bytes=int(os.environ.get('DASHBOARD_CACHE_MB', 256)) * 2 ** 20,
+                        refresh_seconds=60)
+
+
+@st.experimental_memo(ttl=60, max_entries=20)
 def get_data(start_date: str = '2020-01-01',
-             end_date: str = '2025-01-01') -> pd.DataFrame:
-
-    conn = get_db_connection()
-    # query the database with start and end data
-    sql = f"""select * from tweets_analytics
-              where timestamp between date('{start_date}') and date('{end_date}')
-              """
-    print(sql)
-    df = pd.read_sql_query(sql, conn)
-    # add some metadata to the string to show more details
-    now = str(datetime.datetime.now())[:-7]
-    st.sidebar.markdown(f"""**Latest update data :**
-                            {now}
-                        Adjust starting date or ending date to refresh data""")
+             end_date: str = '2025-01-01',
+             keyword: str = '',
+             limit: Optional[int] = 10000,
+             offset: int = 0) -> pd.DataFrame:
+
+    # query the database with start and end data, the keyword filter and the limit
+    sql, params = build_query(start_date, end_date, keyword=keyword,
+                              limit=limit, offset=offset)
+    thread_metrics().count('dashboard_db_queries')
+    # the connection is kept open between reruns
+    with db_connection() as conn, thread_metrics().timer('dashboard_keyword_query'):
+        df = pd.read_sql_query(sql, conn, params=params)
+    return compact_frame(df)
+
+
+@st.experimental_memo(ttl=60, max_entries=100)
+def get_page(start_date: str,
+             end_date: str,
+             keyword: str = '',
+             page_size: int = 100,
+             after: Optional[Tuple[str, str]] = None,
+             descending: bool = True) -> pd.DataFrame:
+    sql, params = build_page_query(start_date, end_date, keyword=keyword, page_size=page_size,
+                                   after=after, descending=descending)
+    thread_metrics().count('dashboard_db_queries')
+    with db_connection() as conn, thread_metrics().timer('dashboard_page_query'):
+        df = pd.read_sql_query(sql, conn, params=params)
+    return compact_frame(df)
+
+
+@st.experimental_memo(ttl=60, max_entries=20)
+def count_rows(start_date: str,
+               end_date: str,
+               keyword: str = '',
+               table_name: str = 'tweets_analytics') -> Tuple[int, bool]:
+    '''
+    number of rows in the range and whether it is exact, without counting them one by one.
+    Without keyword it is the sum of the hourly rollups, with a keyword or when the range
+    has no rollups the estimate of the query planner, counted exactly only when it is small
+    '''
+    where, params = where_clause(start_date, end_date, keyword)
+    thread_metrics().count('dashboard_db_queries')
+    with db_connection() as conn, conn.cursor() as cur, \
+            thread_metrics().timer('dashboard_count_query'):
+        if not keyword:
+            # the same bounds as the page query: the hours from the start date up to
+            # the end date, plus the rows at midnight of the end date
+            try:
+                cur.execute(f"""select sum(n) from {ROLLUP_TABLE}
+                                where source_table = %s and resolution = 'hour'
+                                  and bucket >= date(%s) and bucket < date(%s)""",
+                            [table_name, start_date, end_date])
+                rollup_rows = cur.fetchone()[0]
+            except psycopg2.errors.UndefinedTable:
+                conn.rollback()
+                rollup_rows = None
+            if rollup_rows:
+                cur.execute(f"select count(*) from {table_name} where timestamp = date(%s)",
+                            [end_date])
+                return int(rollup_rows) + int(cur.fetchone()[0]), False
+        cur.execute(f"explain (format json) select 1 from {table_name} {where}", params)
+        estimate = int(cur.fetchone()[0][0]['Plan']['Plan Rows'])
+        if estimate >= EXACT_COUNT_LIMIT:
+            return estimate, False
+        cur.execute(f"select count(*) from {table_name} {where}", params)
+        return int(cur.fetchone()[0]), True
+
+
+def get_rows(start_date: str,
+             end_date: str,
+             keyword: str = '',
+             limit: Optional[int] = 10000) -> pd.DataFrame:
+    '''
+    without keyword the rows are sliced from the dataset cache,
+    a keyword search goes to the full text index in the DB
+    '''
+    if keyword:
+        return get_data(start_date=start_date, end_date=end_date,
+                        keyword=keyword, limit=limit)
+    cache = get_dataset_cache()
+    queries = cache.queries
+    df = cache.get_range(start_date, end_date, limit=limit)
+    # a hit when no day had to be read from the DB
+    thread_metrics().count('dashboard_cache_hits' if cache.queries == queries else 'dashboard_cache_misses')
     return df
 
 
+@st.experimental_memo(ttl=60, max_entries=20)
+def get_sentiment_over_time(start_date: str,
+                            end_date: str,
+                            keyword: str = '',
+                            max_points: int = MAX_CHART_POINTS,
+                            table_name: str = 'tweets_analytics') -> pd.DataFrame:
+    '''
+    count, mean, min and max of the sentiment score over time with at most `max_points` points,
+    read from the rollups at the finest resolution that fits the range
+    '''
+    start = pd.Timestamp(start_date, tz='UTC').to_pydatetime()
+    end = pd.Timestamp(end_date, tz='UTC').to_pydatetime()
+    # read a few buckets more than the points so they can be merged evenly
+    resolution = choose_resolution(start, end, max_buckets=10 * max_points)
+    thread_metrics().count('dashboard_db_queries')
+    with db_connection() as conn, thread_metrics().timer('dashboard_chart_query'):
+        if keyword:
+            # there are no rollups per keyword, aggregate the matching rows in the DB
+            where, params = where_clause(start_date, end_date, keyword)
+            sql = f"""select date_trunc(%s, timestamp at time zone 'UTC') at time zone 'UTC' as bucket,
+                             count(*) as n, sum(sentiment_score) as sum_score,
+                             min(sentiment_score) as min_score, max(sentiment_score) as max_score
+                      from {table_name} {where} and sentiment_score is not null
+                      group by 1 order by 1"""
+            df = pd.read_sql_query(sql, conn, params=[resolution] + params)
+        else:
+            df = read_rollups(conn, table_name, resolution, start, end)
+    return downsample(df, max_points)
+
+
 def get_local_tz() -> datetime.timezone:
     return datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
 
-@st.cache
-def process_data(df: pd.DataFrame,
-                 keyword: str,
-                 start_date: str,
-                 end_date: str) -> pd.DataFrame:
-    # convert to local timezone
-    local_tz = get_local_tz()
-    df['timestamp'] = df['timestamp'].dt.tz_convert(local_tz)
-    # remove author column as that is always reuters
-    df = df.drop(columns=['author'])
-    # select only tweets with the keyword we selected
-    if keyword:
-        df = df.loc[df['text'].str.contains(keyword),: ]
-    # avoid to display 10 decimal places
-    df['sentiment_score'] = df['sentiment_score'].round(2)
-    # sort column order
-    df = df.reindex(['timestamp', 'sentiment_score', 'text'], axis=1)
-    return df
+def process_data(df: pd.DataFrame) -> pd.DataFrame:
+    # convert to local timezone, the rows can be the cached ones so they are not modified
+    return prepare_for_display(df, get_local_tz())
 
 
-def display_table(df: pd.DataFrame) -> None:
+def display_table(df: pd.DataFrame, sortable: bool = True) -> None:
     # this is some javascript code
     # to color cells
     # positive -> green, neuter -> white negative -> red
@@ -81,8 +205,14 @@ def display_table(df: pd.DataFrame) -> None:
     };
     """)
     gb = GridOptionsBuilder.from_dataframe(df)
+    # a page is sorted by the DB, sorting it in the browser would only sort the page
+    gb.configure_default_column(sortable=sortable)
+    if 'author' in df.columns:
+        gb.configure_column('author', hide=True)
+    # avoid to display 10 decimal places, the browser rounds instead of pandas
     gb.configure_column("sentiment_score",
-                        cellStyle=sentiment_score_style)
+                        cellStyle=sentiment_score_style,
+                        valueFormatter="value == null ? '' : value.toFixed(2)")
 
     AgGrid(df, height=500, width=1000,
            fit_columns_on_grid_load=False,
@@ -90,17 +220,71 @@ def display_table(df: pd.DataFrame) -> None:
            allow_unsafe_jscode=True)
     return None
 
+
+def _page_cursors(filters: tuple) -> list:
+    '''
+    cursors of the pages seen, kept in the session: the last one is the
+    start of the current page, going back drops it. Changing a filter starts again
+    '''
+    if st.session_state.get('page_filters') != filters:
+        st.session_state['page_filters'] = filters
+        st.session_state['page_cursors'] = [None]
+    return st.session_state['page_cursors']
+
+
+def display_paged_table(start_date: str,
+                        end_date: str,
+                        keyword: str,
+                        page_size: int,
+                        descending: bool) -> None:
+    '''
+    only the visible page is read and sent to the browser, whatever the size of the range
+    '''
+    cursors = _page_cursors((start_date, end_date, keyword, page_size, descending))
+    with thread_metrics().timer('dashboard_rows'):
+        page = get_page(start_date, end_date, keyword=keyword, page_size=page_size,
+                        after=cursors[-1], descending=descending)
+        total, exact = count_rows(start_date, end_date, keyword=keyword)
+    has_next = len(page) > page_size
+    page = page.iloc[:page_size]
+    thread_metrics().count('dashboard_rows_shown', len(page))
+    if page.empty:
+        st.error('Your search parameters resulted in no data!')
+        return
+    pages = max(-(-total // page_size), len(cursors))
+    st.markdown(f"Page {len(cursors)} of {'' if exact else 'about '}{pages} "
+                f"({'' if exact else '~'}{total} rows)")
+    with thread_metrics().timer('dashboard_table'):
+        display_table(process_data(page), sortable=False)
+    col1, col2, _ = st.columns([1, 1, 6])
+    if len(cursors) > 1:
+        col1.button('Previous', on_click=cursors.pop)
+    if has_next:
+        last = page.iloc[-1]
+        col2.button('Next', on_click=cursors.append,
+                    args=((last['timestamp'].isoformat(), last['author']),))
+
+
 st.set_page_config(layout="wide")
 
 print('If this is printed and the app is not running on the public IP, check port mappings and security group inbound rules')
 if __name__ == "__main__":
 
+    rerun_started = time.perf_counter()
+    # a rerun stopped by a new input did not flush its metrics
+    thread_metrics().reset()
     # here we define the layout of the sidebar
     st.title('Tweet analytics sentiment score dashboard')
     view_name = st.sidebar.radio("", ('View tweets', 'Analytics'))
     keyword = st.sidebar.text_input("Keyword", "")
     start_date = st.sidebar.text_input("Starting date", "2021-01-01")
     end_date = st.sidebar.text_input("End date", "2022-01-01")
+    paged = st.sidebar.checkbox("Paged table", value=True)
+    if paged:
+        page_size = st.sidebar.selectbox("Rows per page", [50, 100, 500, 1000], index=1)
+        descending = st.sidebar.radio("Order", ('Newest first', 'Oldest first')) == 'Newest first'
+    else:
+        max_rows = st.sidebar.number_input("Max rows", min_value=100, value=10000, step=1000)
     st.sidebar.subheader('Explanation')
     st.sidebar.markdown('''
                         **Sentiment score indicates a positive sentiment
@@ -111,19 +295,31 @@ if __name__ == "__main__":
                          or very negative.***
                          ''')
     # here we run the main 'functionality' of the app
-    df = get_data(start_date=start_date, end_date=end_date)
-    df = process_data(df,
-                      keyword=keyword,
-                      start_date=start_date,
-                      end_date=end_date)
-    # error handling message
-    if df.empty:
-            st.error('Your search parameters resulted in no data!')
+    if st.sidebar.button("Refresh"):
+        # read the rows arrived since the last update now
+        get_dataset_cache().refresh()
+    # add some metadata to the string to show more details
+    last_update = get_dataset_cache().last_update.tz_convert(get_local_tz())
+    st.sidebar.markdown(f"""**Latest update data :**
+                            {last_update:%Y-%m-%d %H:%M:%S}
+                        New data is read every minute or with Refresh""")
 
     col1, col2, col3 = st.columns(3)
-    if view_name == 'View tweets':
+    if view_name == 'View tweets' and paged:
+        display_paged_table(start_date, end_date, keyword, page_size, descending)
+
+    elif view_name == 'View tweets':
         # view tweets View
-        display_table(df)
+        with thread_metrics().timer('dashboard_rows'):
+            df = get_rows(start_date=start_date, end_date=end_date,
+                          keyword=keyword, limit=max_rows)
+        thread_metrics().count('dashboard_rows_shown', len(df))
+        df = process_data(df)
+        # error handling message
+        if df.empty:
+                st.error('Your search parameters resulted in no data!')
+        with thread_metrics().timer('dashboard_table'):
+            display_table(df)
 
     else:
          # Analytics view
@@ -131,6 +327,15 @@ if __name__ == "__main__":
         st.markdown(f"**Sentiment score over time**")
         keyword_info = f"keyword={keyword}" if keyword else ""
         st.markdown(f"{keyword_info} start date={start_date} \n end date={end_date}")
-        # make sure timestamp index is seen on the plot
-        df = df.set_index('timestamp')
-        st.line_chart(df['sentiment_score'])
+        # the chart is built from the rollups, not from the rows in the table
+        with thread_metrics().timer('dashboard_chart'):
+            chart_df = get_sentiment_over_time(start_date, end_date, keyword=keyword)
+            if chart_df.empty:
+                st.error('Your search parameters resulted in no data!')
+            else:
+                # show the timestamps in the local timezone
+                chart_df.index = chart_df.index.tz_convert(get_local_tz())
+                st.line_chart(chart_df[['sentiment_score', 'min', 'max']])
+    # one json metrics line per rerun in the logs of streamlit
+    thread_metrics().add_time('dashboard_rerun', (time.perf_counter() - rerun_started) * 1000)
+    thread_metrics().flush(function='dashboard')
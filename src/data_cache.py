@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In memory copy of the analytics table for the dashboard.
+Rows are kept per UTC day, any date range is answered by slicing the cached
+days and only the missing days are read from the DB, with a row limit only
+until the limit is reached. Rows can be stored late (backfills, retries,
+dead letters), so the days that can still get rows are topped up by reading
+again only their last `late_seconds`, and the least recently used days are
+dropped when the memory budget is exceeded, even the ones just read: a range
+larger than the budget is read every time and never cached
+"""
+
+from collections import OrderedDict
+import threading
+import time
+from typing import Callable, List, Optional
+
+import pandas as pd
+
+
+ONE_DAY = pd.Timedelta(days=1)
+
+# load(start, end, after) returns the rows with start <= timestamp < end
+# (and timestamp > after when after is given) ordered by timestamp
+Loader = Callable[[pd.Timestamp, pd.Timestamp, Optional[pd.Timestamp]], pd.DataFrame]
+
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    timestamps in UTC, float32 scores and arrow backed strings,
+    about half the memory of the float64 and python str objects read from the DB
+    '''
+    df = df.astype({'sentiment_score': 'float32', 'text': 'string[pyarrow]'})
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+    return df
+
+
+def _now() -> pd.Timestamp:
+    return pd.Timestamp.now(tz='UTC')
+
+
+def _rows_between(df: pd.DataFrame, start: pd.Timestamp, end: pd.Timestamp) -> int:
+    timestamps = df['timestamp']
+    return int(timestamps.searchsorted(end, side='right') - timestamps.searchsorted(start, side='left'))
+
+
+def prepare_for_display(df: pd.DataFrame, tz) -> pd.DataFrame:
+    '''
+    rows ready for the table in the local time zone. `df` is not modified
+    and no column is copied: converting the time zone only changes the dtype
+    and the scores are rounded by the grid when they are shown
+    '''
+    display = df.copy(deep=False)
+    display['timestamp'] = df['timestamp'].dt.tz_convert(tz)
+    return display
+
+
+class _Day:
+    __slots__ = ('df', 'latest', 'loaded_at', 'closed', 'nbytes')
+
+    def __init__(self, df: pd.DataFrame, day: pd.Timestamp, loaded_at: pd.Timestamp,
+                 late: pd.Timedelta):
+        self.df = df
+        # newest timestamp read
+        self.latest = df['timestamp'].iloc[-1] if len(df) else None
+        self.loaded_at = loaded_at
+        # a day read more than `late` after its end will not change anymore
+        self.closed = loaded_at - late >= day + ONE_DAY
+        self.nbytes = int(df.memory_usage(deep=True).sum())
+
+
+class DatasetCache:
+    '''
+    Rows of one table cached per day, read with `get_range`.
+    `load` reads the rows from the DB, `max_bytes` is the memory budget and
+    the open days are topped up at most every `refresh_seconds`. Rows stored up to
+    `late_seconds` after their timestamp are seen, later ones only once the day is read again
+    '''
+
+    def __init__(self, load: Loader,
+                 max_bytes: int = 256 * 2 ** 20,
+                 refresh_seconds: float = 60.0,
+                 late_seconds: float = 24 * 3600.0):
+        self.load = load
+        self.max_bytes = max_bytes
+        self.refresh_seconds = refresh_seconds
+        self.late = pd.Timedelta(seconds=late_seconds)
+        # day (UTC midnight) -> rows of that day, least recently used first
+        self._days: 'OrderedDict[pd.Timestamp, _Day]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshed_at = time.monotonic()
+        self.last_update = _now()
+        self.queries = 0
+
+    @property
+    def nbytes(self) -> int:
+        return sum(day.nbytes for day in self._days.values())
+
+    def _query(self, start: pd.Timestamp, end: pd.Timestamp,
+               after: Optional[pd.Timestamp] = None) -> pd.DataFrame:
+        self.queries += 1
+        return compact_frame(self.load(start, end, after))
+
+    def _load_days(self, days: List[pd.Timestamp]) -> None:
+        # one query for every run of consecutive missing days
+        runs = []
+        for day in days:
+            if runs and runs[-1][-1] + ONE_DAY == day:
+                runs[-1].append(day)
+            else:
+                runs.append([day])
+        for run in runs:
+            loaded_at = _now()
+            df = self._query(run[0], run[-1] + ONE_DAY)
+            day_of_row = df['timestamp'].dt.floor('D')
+            for day in run:
+                rows = df[(day_of_row == day).to_numpy()].reset_index(drop=True)
+                self._days[day] = _Day(rows, day, loaded_at, self.late)
+
+    def _top_up(self) -> None:
+        '''
+        for the days that can still get rows, read again the rows that could have
+        been stored since the last read: the ones newer than what is cached and
+        the ones up to `late_seconds` older than the last read
+        '''
+        for day, cached in list(self._days.items()):
+            if cached.closed:
+                continue
+            loaded_at = _now()
+            after = cached.loaded_at - self.late
+            if cached.latest is not None:
+                after = min(after, cached.latest)
+            if after < day:
+                df = self._query(day, day + ONE_DAY)
+            else:
+                kept = cached.df.iloc[:cached.df['timestamp'].searchsorted(after, side='right')]
+                new_rows = self._query(day, day + ONE_DAY, after=after)
+                df = pd.concat([kept, new_rows], ignore_index=True)
+            # replacing the value keeps the LRU position of the day
+            self._days[day] = _Day(df, day, loaded_at, self.late)
+        self._refreshed_at = time.monotonic()
+        self.last_update = _now()
+
+    def _evict(self) -> None:
+        # least recently used first, the days just read are the last ones dropped
+        total = self.nbytes
+        while self._days and total > self.max_bytes:
+            total -= self._days.popitem(last=False)[1].nbytes
+
+    def refresh(self) -> None:
+        with self._lock:
+            self._top_up()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._days.clear()
+
+    def get_range(self, start_date: str, end_date: str,
+                  limit: Optional[int] = None) -> pd.DataFrame:
+        '''
+        rows with start_date <= timestamp <= end_date (dates at midnight UTC), at most `limit`.
+        The cached rows are never modified, the result must not be modified either
+        '''
+        start = pd.Timestamp(start_date, tz='UTC')
+        end = pd.Timestamp(end_date, tz='UTC')
+        days = list(pd.date_range(start.floor('D'), end.floor('D'), freq='D'))
+        pieces = []
+        with self._lock:
+            if time.monotonic() - self._refreshed_at > self.refresh_seconds:
+                self._top_up()
+            rows = 0
+            # with a limit the missing days are read 1, 2, 4... at a time
+            # and no more once the limit is reached
+            run_days = 1 if limit is not None else len(days)
+            for i, day in enumerate(days):
+                if limit is not None and rows >= limit:
+                    break
+                if day not in self._days:
+                    missing = []
+                    for next_day in days[i:i + run_days]:
+                        if next_day in self._days:
+                            break
+                        missing.append(next_day)
+                    self._load_days(missing)
+                    run_days *= 2
+                self._days.move_to_end(day)
+                pieces.append(self._days[day].df)
+                rows += _rows_between(pieces[-1], start, end)
+            self._evict()
+        df = pd.concat(pieces, ignore_index=True) if pieces else self._query(start, start)
+        # the rows are sorted, slicing by position makes no copy unlike a boolean mask
+        first = df['timestamp'].searchsorted(start, side='left')
+        last = df['timestamp'].searchsorted(end, side='right')
+        if limit is not None:
+            last = min(last, first + limit)
+        return df.iloc[first:last]
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Raw messages archive on S3.
+Every run writes one gzip'd NDJSON object (one json record per line)
+under keys partitioned by table, date and hour like
+raw-messages/tweets_analytics/dt=2021-11-15/hour=11/112519-3f9a1c2b.json.gz
+"""
+
+from __future__ import annotations
+
+from datetime import datetime
+from functools import lru_cache
+import gzip
+import io
+import json
+import os
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Optional
+import uuid
+
+import pytz
+
+if TYPE_CHECKING:
+    from botocore.client import BaseClient
+
+
+RAW_PREFIX = 'raw-messages'
+
+
+@lru_cache(maxsize=None)
+def get_s3_client() -> BaseClient:
+    '''
+    one client per container, S3_ENDPOINT_URL points it to a local S3 (i.e. moto or minio)
+    '''
+    import boto3
+    return boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL') or None)
+
+
+def table_prefix(table_name: str, prefix: str = RAW_PREFIX) -> str:
+    # the records of each table are kept apart, replay and compaction read only one of them
+    return f'{prefix}/{table_name}'
+
+
+def partition_prefix(prefix: str, when: datetime) -> str:
+    when = when.astimezone(pytz.UTC)
+    return f'{prefix}/dt={when:%Y-%m-%d}/hour={when:%H}/'
+
+
+def archive_key(prefix: str, when: datetime) -> str:
+    # the random part avoids overwriting when two runs end in the same second
+    when = when.astimezone(pytz.UTC)
+    return f'{partition_prefix(prefix, when)}{when:%H%M%S}-{uuid.uuid4().hex[:8]}.json.gz'
+
+
+def serialize_records(records: Iterable[dict]) -> io.BytesIO:
+    '''
+    write the records as gzip'd NDJSON in memory, no file in /tmp is needed
+    '''
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as gz:
+        for record in records:
+            gz.write(json.dumps(record, separators=(',', ':')).encode('utf-8'))
+            gz.write(b'\n')
+    buffer.seek(0)
+    return buffer
+
+
+def upload_records(records: Iterable[dict],
+                   bucket: str,
+                   prefix: str = RAW_PREFIX,
+                   now: Optional[datetime] = None) -> str:
+    '''
+    upload the records and return the key of the new object,
+    big batches are sent as a multipart upload by boto3
+    '''
+    now = now or datetime.now(tz=pytz.UTC)
+    key = archive_key(prefix, now)
+    get_s3_client().upload_fileobj(
+        serialize_records(records), bucket, key,
+        ExtraArgs={'ContentType': 'application/x-ndjson'})
+    return key
+
+
+def list_objects(bucket: str, prefix: str) -> Iterator[dict]:
+    '''
+    every object under the prefix, in key order, a page of 1000 at a time
+    '''
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        yield from page.get('Contents', [])
+
+
+def parse_records(key: str, body: bytes) -> List[dict]:
+    '''
+    read both the gzip'd NDJSON objects and the older plain json lists
+    '''
+    if key.endswith('.gz'):
+        body = gzip.decompress(body)
+    if key.endswith('.json'):
+        return json.loads(body)
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+def read_records(bucket: str, key: str) -> List[dict]:
+    body = get_s3_client().get_object(Bucket=bucket, Key=key)['Body'].read()
+    return parse_records(key, body)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure how long each module takes to import in a fresh interpreter,
+which is what a new lambda container pays before the first invocation.
+
+Run it from the `src` folder, i.e.
+    python -m lambda_.coldstart lambda_.lambda_function_guardian pandas boto3
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from typing import Dict, List
+
+
+DEFAULT_MODULES = ['lambda_.lambda_function_guardian',
+                   'lambda_.lambda_function',
+                   'lambda_.sentiment',
+                   'pandas', 'boto3', 'psycopg2', 'nltk', 'requests']
+
+
+def _parse_importtime(stderr: str) -> List[dict]:
+    '''
+    parse the lines written by `python -X importtime` like
+    'import time:       412 |       1234 |   pandas.core'
+    '''
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        entries.append(dict(module=name.strip(),
+                            self_ms=int(self_us) / 1000,
+                            cumulative_ms=int(cumulative_us) / 1000))
+    return entries
+
+
+def measure_import(module: str, top: int = 5) -> dict:
+    '''
+    import `module` in a new python process and return its wall clock import time
+    together with the slowest modules it pulled in
+    '''
+    code = ('import time; start = time.perf_counter(); '
+            f'import {module}; '
+            'print(time.perf_counter() - start)')
+    env = dict(os.environ)
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [src_dir, env.get('PYTHONPATH')]))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        return dict(module=module, error=result.stderr.strip().splitlines()[-1])
+    entries = _parse_importtime(result.stderr)
+    slowest = sorted(entries, key=lambda entry: entry['self_ms'], reverse=True)[:top]
+    return dict(module=module,
+                wall_ms=round(float(result.stdout.strip().splitlines()[-1]) * 1000, 1),
+                modules_loaded=len(entries),
+                slowest=slowest)
+
+
+def measure_imports(modules: List[str], top: int = 5) -> Dict[str, dict]:
+    return {module: measure_import(module, top=top) for module in modules}
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    arg_parser.add_argument('--top', type=int, default=5,
+                            help='number of slowest sub modules to show')
+    arg_parser.add_argument('--json', action='store_true',
+                            help='print the results as json to compare runs')
+    args = arg_parser.parse_args()
+
+    results = measure_imports(args.modules, top=args.top)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for module, result in results.items():
+        if 'error' in result:
+            print(f'{module:40} FAILED {result["error"]}')
+            continue
+        print(f'{module:40} {result["wall_ms"]:>8.1f} ms '
+              f'({result["modules_loaded"]} modules)')
+        for entry in result['slowest']:
+            print(f'    {entry["module"]:36} {entry["self_ms"]:>8.1f} ms')
+
+
+if __name__ == "__main__":
+    main()
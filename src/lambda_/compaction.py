@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact the small raw-messages objects of one table and date/hour partition
+in a single parquet file with a fixed schema, plus a manifest, i.e.
+raw-messages/tweets_analytics/dt=2021-11-15/hour=11/*.json.gz
+-> compacted/tweets_analytics/dt=2021-11-15/hour=11/part-00000.parquet
+   compacted/tweets_analytics/dt=2021-11-15/hour=11/_manifest.json
+
+It runs as a lambda (i.e. scheduled every hour, it compacts the previous hour
+of every table in COMPACTION_TABLES) or from the `src` folder with
+    python -m lambda_.compaction --bucket my-bucket --table tweets_analytics --date 2021-11-15 --hour 11
+"""
+
+from __future__ import annotations
+
+import argparse
+from datetime import date, datetime, timedelta
+import io
+import json
+import logging
+import os
+from typing import TYPE_CHECKING, Dict, Optional
+
+import pytz
+
+from lambda_.archive import RAW_PREFIX, get_s3_client, list_objects, read_records, table_prefix
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+
+
+COMPACTED_PREFIX = 'compacted'
+COLUMNS = ['timestamp', 'author', 'text', 'sentiment_score', 'post_id']
+TABLES = os.environ.get('COMPACTION_TABLES', 'tweets_analytics,guardian_posts_analytics')
+
+
+def schema() -> pa.Schema:
+    import pyarrow as pa
+    return pa.schema([('timestamp', pa.timestamp('us', tz='UTC')),
+                      ('author', pa.string()),
+                      ('text', pa.string()),
+                      ('sentiment_score', pa.float64()),
+                      ('post_id', pa.string())])
+
+
+def post_identity(df: pd.DataFrame) -> pd.Series:
+    '''
+    the id given by the API, records archived without it are told apart
+    by author, time and text: posts published in the same second differ by their text
+    '''
+    fallback = (df['author'].fillna('') + '|' + df['timestamp'].astype(str)
+                + '|' + df['text'].fillna(''))
+    return df['post_id'].fillna(fallback)
+
+
+def _partition(prefix: str, day: date, hour: Optional[int] = None) -> str:
+    partition = f'{prefix}/dt={day:%Y-%m-%d}/'
+    if hour is not None:
+        partition += f'hour={hour:02d}/'
+    return partition
+
+
+def compact_partition(bucket: str,
+                      table_name: str,
+                      day: date,
+                      hour: Optional[int] = None,
+                      source_prefix: str = RAW_PREFIX,
+                      target_prefix: str = COMPACTED_PREFIX) -> Optional[dict]:
+    '''
+    compact one hour (or a whole day if `hour` is None) of a table and return its manifest,
+    running it again overwrites the same file so it is safe to reprocess
+    '''
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    source = _partition(table_prefix(table_name, source_prefix), day, hour)
+    target = _partition(table_prefix(table_name, target_prefix), day, hour)
+    source_keys = []
+    # keep only the columns of the schema, not the raw dictionaries
+    columns = {column: [] for column in COLUMNS}
+    for obj in list_objects(bucket, source):
+        source_keys.append(obj['Key'])
+        for record in read_records(bucket, obj['Key']):
+            for column in COLUMNS:
+                columns[column].append(record.get(column))
+    if not source_keys:
+        logging.info(f'nothing to compact under {source}')
+        return None
+
+    df = pd.DataFrame(columns)
+    rows_in = len(df)
+    df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s', utc=True)
+    df['sentiment_score'] = df['sentiment_score'].astype('float64')
+    # the same post can be archived by more than one run, keep the last one
+    df = (df[~post_identity(df).duplicated(keep='last')]
+            .sort_values('timestamp')
+            .reset_index(drop=True))
+    table = pa.Table.from_pandas(df, schema=schema(), preserve_index=False)
+
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='snappy')
+    data_key = f'{target}part-00000.parquet'
+    s3 = get_s3_client()
+    s3.put_object(Bucket=bucket, Key=data_key, Body=buffer.getvalue())
+
+    manifest = dict(partition=target,
+                    files=[data_key],
+                    source_keys=source_keys,
+                    rows_in=rows_in,
+                    rows_out=len(df),
+                    min_timestamp=df['timestamp'].min().isoformat() if len(df) else None,
+                    max_timestamp=df['timestamp'].max().isoformat() if len(df) else None,
+                    created_at=datetime.now(tz=pytz.UTC).isoformat())
+    # the manifest is written last, its presence means the partition is complete
+    s3.put_object(Bucket=bucket, Key=f'{target}_manifest.json',
+                  Body=json.dumps(manifest, indent=1).encode('utf-8'),
+                  ContentType='application/json')
+    print(f'compacted {len(source_keys)} objects, {rows_in} -> {len(df)} rows into {data_key}')
+    return manifest
+
+
+def compaction_handler(event, context):
+    '''
+    compact the hour in the event ({"date": "2021-11-15", "hour": 11}) of every table,
+    the previous hour by default because the current one is still being written
+    '''
+    if event and 'date' in event:
+        day = date.fromisoformat(event['date'])
+        hour = event.get('hour')
+    else:
+        previous_hour = datetime.now(tz=pytz.UTC) - timedelta(hours=1)
+        day, hour = previous_hour.date(), previous_hour.hour
+    manifests: Dict[str, Optional[dict]] = {}
+    for table_name in TABLES.split(','):
+        manifests[table_name] = compact_partition(bucket=os.environ['S3_BUCKET_NAME'],
+                                                  table_name=table_name.strip(), day=day,
+                                                  hour=None if hour is None else int(hour))
+    return manifests
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='compact a raw-messages partition')
+    arg_parser.add_argument('--bucket', default=os.environ.get('S3_BUCKET_NAME'))
+    arg_parser.add_argument('--table', required=True,
+                            help='i.e. tweets_analytics or guardian_posts_analytics')
+    arg_parser.add_argument('--date', required=True, type=date.fromisoformat)
+    arg_parser.add_argument('--hour', type=int, default=None,
+                            help='compact only this hour, all the day if not given')
+    args = arg_parser.parse_args()
+    compact_partition(bucket=args.bucket, table_name=args.table, day=args.date, hour=args.hour)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Postgres connections shared by the lambda functions and the dashboard.
+Connections are kept open in a small pool so that warm lambda invocations
+and streamlit reruns do not pay a new handshake every time
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+import io
+import logging
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, NamedTuple, Sequence, Tuple
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import psycopg2
+
+
+def _connect() -> psycopg2.extensions.connection:
+    import psycopg2
+
+    # to connect to DB, use the parameters and password that define it
+    conn = psycopg2.connect(
+                            user="postgres",
+                            password=os.environ['DB_PASSWORD'],
+                            host=os.environ['DB_HOST'],
+                            port="5432",
+                            connect_timeout=1,
+                            # let the OS notice dead connections while they are idle
+                            keepalives=1,
+                            keepalives_idle=30)
+    return conn
+
+
+class ConnectionPool:
+    '''
+    Keep up to `max_size` connections open. Idle connections are checked
+    with a `SELECT 1` only if they were not used in the last
+    `health_check_interval` seconds, broken ones are replaced by new ones
+    '''
+
+    def __init__(self, connect: Callable[[], psycopg2.extensions.connection],
+                 max_size: int = 2,
+                 health_check_interval: float = 30.0):
+        self.connect = connect
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        # (connection, time it was released) of the connections not in use
+        self._idle: List[Tuple[psycopg2.extensions.connection, float]] = []
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def _is_healthy(self, conn: psycopg2.extensions.connection,
+                    released_at: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            logging.warning('dropping broken DB connection', exc_info=True)
+            return False
+
+    def _discard(self, conn: psycopg2.extensions.connection) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def acquire(self, timeout: float = 10.0) -> psycopg2.extensions.connection:
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._condition:
+                if self._idle:
+                    # take the most recently used connection, it is the most likely to be alive
+                    conn, released_at = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                    conn, released_at = None, None
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RuntimeError(f'all {self.max_size} DB connections are in use')
+                    self._condition.wait(remaining)
+                    continue
+            # checks and connects happen outside the lock
+            if conn is None:
+                try:
+                    return self.connect()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+            if self._is_healthy(conn, released_at):
+                return conn
+            self._discard(conn)
+
+    def release(self, conn: psycopg2.extensions.connection) -> None:
+        import psycopg2.extensions
+
+        if conn.closed:
+            self._discard(conn)
+            return
+        # do not hand over a connection with an open transaction
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+        with self._condition:
+            self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self) -> Iterator[psycopg2.extensions.connection]:
+        import psycopg2
+
+        conn = self.acquire()
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # the connection itself is probably gone, do not reuse it
+            self._discard(conn)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+
+# one pool per lambda container / streamlit process
+pool = ConnectionPool(_connect, max_size=int(os.environ.get('DB_POOL_SIZE', 2)))
+
+
+def db_connection():
+    '''
+    use as `with db_connection() as conn:`,
+    the connection goes back to the pool at the end of the block
+    '''
+    return pool.connection()
+
+
+# columns of each table, read once per container
+_table_columns: Dict[str, List[str]] = {}
+
+
+def table_columns(conn: psycopg2.extensions.connection, table_name: str) -> List[str]:
+    if table_name not in _table_columns:
+        with conn.cursor() as cur:
+            cur.execute(f'SELECT * FROM {table_name} LIMIT 0')
+            _table_columns[table_name] = [column.name for column in cur.description]
+        conn.commit()
+    return _table_columns[table_name]
+
+
+def primary_key(conn: psycopg2.extensions.connection, table_name: str) -> List[str]:
+    '''
+    the columns of the primary key of `table_name` in their order, empty if it has none
+    '''
+    with conn.cursor() as cur:
+        cur.execute("""SELECT a.attname
+                       FROM pg_index i
+                       JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+                       WHERE i.indrelid = %s::regclass AND i.indisprimary
+                       ORDER BY array_position(i.indkey::int2[], a.attnum)""", (table_name,))
+        columns = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    return columns
+
+
+class LoadResult(NamedTuple):
+    inserted: int
+    updated: int
+    # rows already in the table (or repeated in the same batch)
+    skipped: int
+
+
+# COPY reads an unquoted empty field as NULL by default, and pandas writes empty texts that way
+NULL_MARKER = r'\N'
+
+
+class _CsvStream(io.TextIOBase):
+    '''
+    file-like object that renders the DataFrame as csv a chunk at a time,
+    so COPY can stream it without building the whole text in memory.
+    Missing values are written as NULL_MARKER, an empty text stays an empty text
+    '''
+
+    def __init__(self, df: pd.DataFrame, chunk_rows: int = 10000):
+        self._chunks = (df.iloc[start:start + chunk_rows]
+                        for start in range(0, len(df), chunk_rows))
+        self._buffer = ''
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk.to_csv(index=False, header=False, na_rep=NULL_MARKER)
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _identifier(name: str):
+    from psycopg2 import sql
+    # allow schema qualified names like public.tweets_analytics
+    return sql.Identifier(*name.split('.'))
+
+
+def bulk_upsert(df: pd.DataFrame,
+                conn: psycopg2.extensions.connection,
+                table_name: str,
+                key_columns: Sequence[str] = ('author', 'timestamp'),
+                on_conflict: str = 'nothing') -> LoadResult:
+    '''
+    COPY the rows into a temporary staging table and merge them into `table_name`.
+    Rows whose key is already stored are skipped (`on_conflict='nothing'`)
+    or overwritten (`on_conflict='update'`), so loading the same data twice is harmless.
+    Every key column must be in `df`, they are the conflict target of the table
+    '''
+    from psycopg2 import sql
+
+    if on_conflict not in ('nothing', 'update'):
+        raise ValueError(f"on_conflict must be 'nothing' or 'update', not {on_conflict!r}")
+    columns = list(df.columns)
+    missing = [column for column in key_columns if column not in columns]
+    if missing:
+        # a narrower conflict target would not match the primary key of the table
+        raise ValueError(f'the rows for {table_name} have no key column {", ".join(missing)}')
+    keys = list(key_columns)
+    stage = sql.Identifier('stage_' + table_name.replace('.', '_'))
+    target = _identifier(table_name)
+    column_list = sql.SQL(',').join(map(sql.Identifier, columns))
+    key_list = sql.SQL(',').join(map(sql.Identifier, keys))
+    updates = [column for column in columns if column not in keys]
+    if on_conflict == 'update' and updates:
+        conflict_action = sql.SQL('DO UPDATE SET {}').format(sql.SQL(',').join(
+            sql.SQL('{0} = EXCLUDED.{0}').format(sql.Identifier(column))
+            for column in updates))
+    else:
+        conflict_action = sql.SQL('DO NOTHING')
+    # the staging table has only the columns, no constraints, and disappears at commit
+    create_stage = sql.SQL("""CREATE TEMP TABLE {stage} ON COMMIT DROP AS
+                              SELECT {columns} FROM {target} WITH NO DATA""")
+    copy = sql.SQL("COPY {stage} ({columns}) FROM STDIN WITH (FORMAT csv, NULL {null})")
+    # DISTINCT ON drops keys repeated inside the batch, ON CONFLICT can update a row only once
+    # xmax = 0 only for newly inserted rows
+    merge = sql.SQL("""WITH merged AS (
+                           INSERT INTO {target} ({columns})
+                           SELECT DISTINCT ON ({keys}) {columns} FROM {stage}
+                           ON CONFLICT ({keys}) {action}
+                           RETURNING (xmax = 0) AS inserted)
+                       SELECT count(*) FILTER (WHERE inserted),
+                              count(*) FILTER (WHERE NOT inserted)
+                       FROM merged""")
+    try:
+        with conn.cursor() as cur:
+            cur.execute(create_stage.format(stage=stage, columns=column_list, target=target))
+            cur.copy_expert(copy.format(stage=stage, columns=column_list,
+                                        null=sql.Literal(NULL_MARKER)).as_string(conn),
+                            _CsvStream(df))
+            cur.execute(merge.format(target=target, columns=column_list, keys=key_list,
+                                     stage=stage, action=conflict_action))
+            inserted, updated = cur.fetchone()
+        conn.commit()
+    except Exception:
+        # rollback to avoid DB lock problems, the caller decides what to do with the batch
+        conn.rollback()
+        raise
+    return LoadResult(inserted=inserted, updated=updated,
+                      skipped=len(df) - inserted - updated)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dead-letter spool for the batches a sink could not store even after retrying.
+A batch is written as gzip'd NDJSON in DEAD_LETTER_DIR (default /tmp/dead-letter)
+and copied to s3://<bucket>/dead-letter/<sink>/<table>/, the local file is
+removed once the copy is in S3. The next invocation sends the spooled batches
+to their sink again before fetching new posts. The failed attempts are counted
+in the key (file.retry-2.json.gz), a batch that still fails after
+DEAD_LETTER_MAX_ATTEMPTS (default 5) is moved to dead-letter/quarantine/ and
+left there for a human, so it does not block the others
+"""
+
+from __future__ import annotations
+
+from datetime import datetime
+import logging
+import os
+import re
+from typing import Iterator, List, NamedTuple
+import uuid
+
+import pytz
+
+from lambda_.archive import get_s3_client, list_objects, parse_records, serialize_records
+
+
+DEAD_LETTER_PREFIX = 'dead-letter'
+QUARANTINE = 'quarantine'
+MAX_ATTEMPTS = int(os.environ.get('DEAD_LETTER_MAX_ATTEMPTS', 5))
+
+_RETRY_SUFFIX = re.compile(r'\.retry-(\d+)\.json\.gz$')
+
+
+def spool_dir() -> str:
+    return os.environ.get('DEAD_LETTER_DIR', '/tmp/dead-letter')
+
+
+class DeadLetter(NamedTuple):
+    sink: str
+    table_name: str
+    # sink/table/file.json.gz, the same in the local folder and under the S3 prefix
+    key: str
+    in_s3: bool
+    # failed attempts to store it, after the first one
+    attempts: int = 0
+
+
+def _letter(key: str, in_s3: bool) -> DeadLetter:
+    sink, table_name, _ = key.split('/', 2)
+    retry = _RETRY_SUFFIX.search(key)
+    return DeadLetter(sink, table_name, key, in_s3, int(retry.group(1)) if retry else 0)
+
+
+def spool(sink: str, table_name: str, records: List[dict], bucket: str) -> bool:
+    '''
+    keep the records (json serializable) for the next run,
+    return True if they reached S3 and False if they are only in /tmp
+    '''
+    now = datetime.now(tz=pytz.UTC)
+    key = f'{sink}/{table_name}/{now:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}.json.gz'
+    body = serialize_records(records).getvalue()
+    path = os.path.join(spool_dir(), key)
+    # on disk first, S3 can be the reason the sink failed
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fout:
+        fout.write(body)
+    try:
+        get_s3_client().put_object(Bucket=bucket, Key=f'{DEAD_LETTER_PREFIX}/{key}', Body=body)
+    except Exception:
+        logging.exception(f'{key} could not be copied to S3, it is only in {path}')
+        return False
+    os.remove(path)
+    logging.warning(f'{len(records)} records spooled to s3://{bucket}/{DEAD_LETTER_PREFIX}/{key}')
+    return True
+
+
+def pending(bucket: str) -> Iterator[DeadLetter]:
+    '''
+    the spooled batches, the ones left in /tmp by this container first
+    '''
+    root = spool_dir()
+    for folder, _, files in sorted(os.walk(root)):
+        for name in sorted(files):
+            yield _letter(os.path.relpath(os.path.join(folder, name), root).replace(os.sep, '/'),
+                          in_s3=False)
+    try:
+        for obj in list_objects(bucket, f'{DEAD_LETTER_PREFIX}/'):
+            key = obj['Key'][len(DEAD_LETTER_PREFIX) + 1:]
+            if not key.startswith(f'{QUARANTINE}/'):
+                yield _letter(key, in_s3=True)
+    except Exception:
+        logging.exception('the dead-letter spool on S3 cannot be listed')
+
+
+def read(letter: DeadLetter, bucket: str) -> List[dict]:
+    if letter.in_s3:
+        body = get_s3_client().get_object(
+            Bucket=bucket, Key=f'{DEAD_LETTER_PREFIX}/{letter.key}')['Body'].read()
+    else:
+        with open(os.path.join(spool_dir(), letter.key), 'rb') as fin:
+            body = fin.read()
+    return parse_records(letter.key, body)
+
+
+def remove(letter: DeadLetter, bucket: str) -> None:
+    if letter.in_s3:
+        get_s3_client().delete_object(Bucket=bucket, Key=f'{DEAD_LETTER_PREFIX}/{letter.key}')
+    else:
+        os.remove(os.path.join(spool_dir(), letter.key))
+
+
+def _move(letter: DeadLetter, key: str, bucket: str) -> None:
+    if letter.in_s3:
+        s3 = get_s3_client()
+        s3.copy_object(Bucket=bucket, Key=key,
+                       CopySource={'Bucket': bucket, 'Key': f'{DEAD_LETTER_PREFIX}/{letter.key}'})
+        s3.delete_object(Bucket=bucket, Key=f'{DEAD_LETTER_PREFIX}/{letter.key}')
+    else:
+        path = os.path.join(spool_dir(), letter.key)
+        with open(path, 'rb') as fin:
+            get_s3_client().put_object(Bucket=bucket, Key=key, Body=fin.read())
+        os.remove(path)
+
+
+def record_failure(letter: DeadLetter, bucket: str) -> DeadLetter:
+    '''
+    count one more failed attempt in the key of the letter, a letter
+    failing MAX_ATTEMPTS times is quarantined. Return the letter as it is now
+    '''
+    attempts = letter.attempts + 1
+    name = _RETRY_SUFFIX.sub('.json.gz', letter.key)
+    if attempts >= MAX_ATTEMPTS:
+        # kept for a human to look at, pending() does not give it anymore
+        key = f'{DEAD_LETTER_PREFIX}/{QUARANTINE}/{name}'
+        _move(letter, key, bucket)
+        logging.error(f'dead letter {letter.key} failed {attempts} times, moved to s3://{bucket}/{key}')
+        return DeadLetter(letter.sink, letter.table_name, f'{QUARANTINE}/{name}', True, attempts)
+    key = name[:-len('.json.gz')] + f'.retry-{attempts}.json.gz'
+    if letter.in_s3:
+        _move(letter, f'{DEAD_LETTER_PREFIX}/{key}', bucket)
+    else:
+        os.replace(os.path.join(spool_dir(), letter.key), os.path.join(spool_dir(), key))
+    return DeadLetter(letter.sink, letter.table_name, key, letter.in_s3, attempts)
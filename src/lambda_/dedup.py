@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ids of the posts already ingested by the previous runs, so the posts seen
+again (overlapping pages, a query finding an old post...) are dropped right
+after fetching, before being scored, archived and inserted.
+Each source keeps the 8 byte hashes of its last DEDUP_INDEX_SIZE posts
+(default 50000, 400 KB) in s3://<bucket>/state/dedup/<source>.bin,
+the oldest are forgotten first. Set DEDUP_INDEX_SIZE=0 to turn it off
+"""
+
+from __future__ import annotations
+
+from array import array
+from collections import deque
+from hashlib import blake2b
+import logging
+import os
+from typing import Callable, Iterable, Iterator
+
+from lambda_.archive import get_s3_client
+from lambda_.metrics import metrics
+
+
+DEDUP_PREFIX = 'state/dedup'
+DEDUP_INDEX_SIZE = int(os.environ.get('DEDUP_INDEX_SIZE', 50000))
+
+
+def post_hash(key: str) -> int:
+    # 64 bits, a collision between 50000 ids is about 1 in 10^10
+    return int.from_bytes(blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class DedupIndex:
+    '''
+    hashes of the last `max_size` post ids added, the oldest are dropped first
+    '''
+
+    def __init__(self, max_size: int = DEDUP_INDEX_SIZE, hashes: Iterable[int] = ()):
+        self.max_size = max_size
+        self._order = deque()
+        self._hashes = set()
+        for hashed in hashes:
+            self._add(hashed)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __contains__(self, key: str) -> bool:
+        return post_hash(key) in self._hashes
+
+    def _add(self, hashed: int) -> bool:
+        if hashed in self._hashes:
+            return False
+        self._hashes.add(hashed)
+        self._order.append(hashed)
+        while len(self._order) > self.max_size:
+            self._hashes.discard(self._order.popleft())
+        return True
+
+    def add(self, key: str) -> bool:
+        '''
+        False if the key was already there
+        '''
+        return self._add(post_hash(key))
+
+    def filter_new(self, posts: Iterable[dict], key: Callable[[dict], str]) -> Iterator[dict]:
+        '''
+        the posts whose key was never seen, they are added as they go
+        '''
+        for post in posts:
+            if self.add(key(post)):
+                yield post
+            else:
+                metrics.count('posts_duplicate')
+
+    def to_bytes(self) -> bytes:
+        return array('Q', self._order).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, max_size: int = DEDUP_INDEX_SIZE) -> DedupIndex:
+        hashes = array('Q')
+        hashes.frombytes(data)
+        return cls(max_size, hashes)
+
+
+def index_key(source: str) -> str:
+    return f'{DEDUP_PREFIX}/{source}.bin'
+
+
+def load_index(bucket: str, source: str, max_size: int = DEDUP_INDEX_SIZE) -> DedupIndex:
+    '''
+    the index saved by the last run, an empty one the first time.
+    It only saves work so a failure to read it is not an error, the DB skips duplicates anyway
+    '''
+    from botocore.exceptions import ClientError
+
+    try:
+        with metrics.timer('dedup_load'):
+            body = get_s3_client().get_object(Bucket=bucket, Key=index_key(source))['Body'].read()
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+            logging.exception(f'dedup index of {source} cannot be read, starting empty')
+        return DedupIndex(max_size)
+    return DedupIndex.from_bytes(body, max_size)
+
+
+def save_index(bucket: str, source: str, index: DedupIndex) -> None:
+    try:
+        with metrics.timer('dedup_save'):
+            get_s3_client().put_object(Bucket=bucket, Key=index_key(source), Body=index.to_bytes())
+    except Exception:
+        logging.exception(f'dedup index of {source} cannot be saved, the next run may fetch duplicates')
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fetch many pages of several Guardian queries at once over one HTTP session,
+without going over the API rate limit. Pages are handed over as soon as
+they arrive so the rest of the lambda can work while the others download
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+import threading
+import time
+from typing import (TYPE_CHECKING, Callable, Dict, Iterator, List, NamedTuple,
+                    Optional, Tuple)
+from urllib.parse import parse_qsl
+
+import pytz
+
+from lambda_.metrics import metrics
+
+if TYPE_CHECKING:
+    import requests
+    from lambda_.watermark import Watermark
+
+
+BASE_URL = 'https://content.guardianapis.com/search'
+
+
+def parse_queries(queries: str) -> Dict[str, dict]:
+    '''
+    turn 'q=climate,section=politics,q=economy&section=business' in
+    {name: api params}. The name of the default empty query is 'guardian'
+    so it keeps the watermark of the single query used before
+    '''
+    parsed = {}
+    for query in queries.split(','):
+        query = query.strip()
+        params = dict(parse_qsl(query, keep_blank_values=True))
+        name = 'guardian' if not any(params.values()) else f'guardian:{query}'
+        parsed[name] = params
+    return parsed
+
+
+class TokenBucket:
+    '''
+    allow `rate` requests per second with bursts of `capacity` requests,
+    shared by all the threads of the fetcher
+    '''
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class Page(NamedTuple):
+    query: str
+    page: int
+    total_pages: int
+    posts: List[dict]
+
+
+class GuardianFetcher:
+    '''
+    With a watermark a query is read oldest first starting from it, all its pages
+    are requested at once and the next run continues where this one stopped.
+    Without a watermark it is read newest first and stops at the first old post
+    '''
+
+    def __init__(self, api_key: str,
+                 base_url: str = BASE_URL,
+                 page_size: int = 50,
+                 max_pages: int = 20,
+                 max_workers: int = 4,
+                 requests_per_second: float = 1.0,
+                 burst: float = 1.0,
+                 max_retries: int = 3,
+                 session: Optional[requests.Session] = None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self._session = session
+
+    @property
+    def session(self) -> requests.Session:
+        # one session, its keep-alive connections are shared by all the threads
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
+
+    def _params(self, query_params: dict, page: int,
+                watermark: Optional[Watermark]) -> dict:
+        params = dict(query_params)
+        params.update({'api-key': self.api_key,
+                       'page-size': self.page_size,
+                       'page': page,
+                       'order-by': 'newest'})
+        if watermark is not None:
+            params['order-by'] = 'oldest'
+            params['from-date'] = watermark.timestamp.astimezone(pytz.UTC).strftime('%Y-%m-%dT%H:%M:%SZ')
+        return params
+
+    def get_page(self, name: str, query_params: dict, page: int,
+                 watermark: Optional[Watermark]) -> Page:
+        params = self._params(query_params, page, watermark)
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            with metrics.timer('api_request'):
+                response = self.session.get(self.base_url, params=params, timeout=10)
+            metrics.count('api_requests')
+            if response.status_code != 429 or attempt == self.max_retries:
+                break
+            metrics.count('api_rate_limited')
+            # over the limit anyway (i.e. another client uses the same key)
+            retry_after = float(response.headers.get('Retry-After', 2 ** attempt))
+            logging.warning(f'{name} page {page} rate limited, retrying in {retry_after}s')
+            time.sleep(retry_after)
+        response.raise_for_status()
+        body = response.json()['response']
+        return Page(query=name, page=page,
+                    total_pages=min(body.get('pages', 1), self.max_pages),
+                    posts=body['results'])
+
+    def fetch(self, queries: Dict[str, dict],
+              watermarks: Dict[str, Optional[Watermark]],
+              is_new: Callable[[dict, Optional[Watermark]], bool]
+              ) -> Iterator[Tuple[str, List[dict]]]:
+        '''
+        yield (query name, new posts) for every page as soon as it is downloaded,
+        a post found by more than one query is given once for each of them
+        '''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {executor.submit(self.get_page, name, params, 1, watermarks.get(name))
+                       for name, params in queries.items()}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page = future.result()
+                    metrics.count('posts_fetched', len(page.posts))
+                    watermark = watermarks.get(page.query)
+                    params = queries[page.query]
+                    new_posts = [post for post in page.posts if is_new(post, watermark)]
+                    if watermark is not None and page.page == 1:
+                        # oldest first: every page is needed, ask for them all at once
+                        pending.update(executor.submit(self.get_page, page.query, params,
+                                                       number, watermark)
+                                       for number in range(2, page.total_pages + 1))
+                    elif (watermark is None and page.page < page.total_pages
+                          and len(new_posts) == len(page.posts)):
+                        # newest first: stop as soon as a page reaches old posts
+                        pending.add(executor.submit(self.get_page, page.query, params,
+                                                    page.page + 1, None))
+                    if new_posts:
+                        yield page.query, new_posts
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timers and counters for the lambda functions and the dashboard.
+Each stage is timed with `metrics.timer('score')` (or the `metrics.timed`
+decorator) and counted with `metrics.count('posts_new', n)`; at the end of an
+invocation `metrics.flush(function='guardian')` prints one json line in the
+CloudWatch Embedded Metric Format, so CloudWatch turns it in metrics without
+any API call. Times of the same stage are summed, stages running in parallel
+(i.e. the sinks) can add up to more than the invocation.
+The dashboard uses `thread_metrics()` instead, one Metrics per session thread.
+
+Set METRICS_PROFILE_INTERVAL_MS (i.e. 5) to also sample the stacks of all the
+threads while the timers run, the most frequent lines are added to the json line
+"""
+
+from __future__ import annotations
+
+from collections import Counter
+from contextlib import contextmanager
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'SentimentAnalytics')
+# threads waiting here are idle, not where the time goes
+IDLE_FRAMES = {('threading.py', 'wait'), ('selectors.py', 'select'),
+               ('thread.py', '_worker'), ('queue.py', 'get')}
+
+
+class SamplingProfiler:
+    '''
+    Every `interval` seconds a thread records the line each other thread is
+    running, the lines seen most often are where the time goes
+    '''
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                code = frame.f_code
+                file_name = os.path.basename(code.co_filename)
+                if thread_id != me and (file_name, code.co_name) not in IDLE_FRAMES:
+                    self.samples[f'{file_name}:{code.co_name}:{frame.f_lineno}'] += 1
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def top(self, n: int = 15) -> List[Tuple[str, int]]:
+        return self.samples.most_common(n)
+
+
+class Metrics:
+    '''
+    Milliseconds per stage and counters of one invocation, safe to use from several threads
+    '''
+
+    def __init__(self, namespace: str = NAMESPACE, profile_interval_ms: Optional[float] = None):
+        self.namespace = namespace
+        self.timings: Dict[str, float] = {}
+        self.counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.profiler = SamplingProfiler(profile_interval_ms / 1000) if profile_interval_ms else None
+        self._running_timers = 0
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name: str, milliseconds: float) -> None:
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + milliseconds
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        self._profile(+1)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, (time.perf_counter() - started) * 1000)
+            self._profile(-1)
+
+    def timed(self, name: Optional[str] = None) -> Callable:
+        '''
+        decorator timing every call of a function, by default under its name
+        '''
+        def decorator(function: Callable) -> Callable:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name or function.__name__):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _profile(self, change: int) -> None:
+        # the profiler samples only while at least one timer runs
+        if self.profiler is None:
+            return
+        with self._lock:
+            self._running_timers += change
+            if change > 0 and self._running_timers == 1:
+                self.profiler.start()
+            elif change < 0 and self._running_timers == 0:
+                self.profiler.stop()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.timings.clear()
+            self.counters.clear()
+        if self.profiler is not None:
+            self.profiler.samples.clear()
+
+    def emf(self, **dimensions: str) -> dict:
+        '''
+        the metrics in the CloudWatch Embedded Metric Format, `dimensions`
+        (i.e. function='guardian') are the dimensions of every metric
+        '''
+        with self._lock:
+            timings = {f'{name}_ms': round(value, 3) for name, value in self.timings.items()}
+            counters = dict(self.counters)
+        definitions = ([dict(Name=name, Unit='Milliseconds') for name in timings]
+                       + [dict(Name=name, Unit='Count') for name in counters])
+        record = {'_aws': {'Timestamp': int(time.time() * 1000),
+                           'CloudWatchMetrics': [dict(Namespace=self.namespace,
+                                                      Dimensions=[sorted(dimensions)],
+                                                      Metrics=definitions)]}}
+        record.update(dimensions)
+        record.update(timings)
+        record.update(counters)
+        if self.profiler is not None and self.profiler.samples:
+            # not a metric, only logged
+            record['profile'] = [f'{samples} {line}' for line, samples in self.profiler.top()]
+        return record
+
+    def flush(self, **dimensions: str) -> dict:
+        '''
+        print the json line of this invocation and start again from zero
+        '''
+        record = self.emf(**dimensions)
+        print(json.dumps(record, separators=(',', ':')), flush=True)
+        self.reset()
+        return record
+
+
+def _profile_interval() -> Optional[float]:
+    interval = os.environ.get('METRICS_PROFILE_INTERVAL_MS')
+    return float(interval) if interval else None
+
+
+# one per container, reset by each flush
+metrics = Metrics(profile_interval_ms=_profile_interval())
+
+_thread_local = threading.local()
+
+
+def thread_metrics() -> Metrics:
+    '''
+    Metrics of the current thread. Streamlit reruns the script of each session in
+    its own thread: with one Metrics per thread the flush of a rerun does not
+    reset the counters of the reruns still running in the other sessions
+    '''
+    if getattr(_thread_local, 'metrics', None) is None:
+        _thread_local.metrics = Metrics(profile_interval_ms=_profile_interval())
+    return _thread_local.metrics
@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming ingestion shared by the lambda functions
+    source -> extract -> score -> sinks (S3 archive, DB)
+Posts flow in chunks of at most `chunk_size`, so the memory does not grow with
+the size of the pull and the sinks store the first chunks while the source is
+still fetching. Every sink works in its own thread and retries a failing
+chunk a few times, a chunk that still fails goes to the dead-letter spool
+(lambda_/dead_letter.py) and is stored by the next run.
+A source adapter (i.e. GuardianSource, TwitterSource) only tells how to fetch
+and format the posts of its API, several sources can run at once.
+
+With handler `lambda_.pipeline.pipeline_handler` one lambda ingests every source
+listed in PIPELINE_SOURCES (i.e. 'guardian,twitter')
+"""
+
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+import logging
+import os
+import random
+import time
+from typing import (TYPE_CHECKING, Any, Callable, Iterable, Iterator, List, NamedTuple,
+                    Optional)
+
+import numpy as np
+import pytz
+
+from lambda_ import dead_letter
+from lambda_.dedup import DEDUP_INDEX_SIZE, load_index, save_index
+from lambda_.archive import table_prefix, upload_records
+from lambda_.db import LoadResult, bulk_upsert, db_connection, table_columns
+from lambda_.metrics import metrics
+from lambda_.rollups import refresh_rollups
+from lambda_.sentiment import VERSION_COLUMN, engine
+
+# heavy modules are imported on first use to keep the cold start short
+if TYPE_CHECKING:
+    import pandas as pd
+    import psycopg2
+
+
+DEFAULT_CHUNK_SIZE = 500
+SINK_ATTEMPTS = 3
+
+
+class Source:
+    '''
+    Adapter of one API. `posts` gives the posts not ingested yet and `extract`
+    turns each of them in a row of `table_name`. The position reached
+    (i.e. the watermarks) is read in `open` and saved in `commit`,
+    which is called only once every row is stored
+    '''
+    name = 'source'
+    table_name = ''
+
+    def open(self, conn: psycopg2.extensions.connection) -> None:
+        pass
+
+    def posts(self) -> Iterator[dict]:
+        raise NotImplementedError
+
+    def extract(self, post: dict) -> dict:
+        raise NotImplementedError
+
+    def post_key(self, post: dict) -> str:
+        # unique id of a raw post, for the dedup index
+        raise NotImplementedError
+
+    def commit(self, conn: psycopg2.extensions.connection) -> None:
+        pass
+
+
+def chunked(items: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def add_sentiment_scores(posts: List[dict]) -> np.ndarray:
+    '''
+    score all the posts in one batch, repeated texts are taken from the cache.
+    The scores and the version of the engine are added to each post, the scores are returned as an array
+    '''
+    hits, misses = engine.hits, engine.misses
+    scores = engine.score_many(post['text'] for post in posts)
+    version = engine.version
+    for post, score in zip(posts, scores):
+        post['sentiment_score'] = float(score)
+        # stored if the table has the column, lambda_.rescore skips these rows
+        post[VERSION_COLUMN] = version
+    metrics.count('posts_scored', len(posts))
+    # approximate when several sources score at the same time
+    metrics.count('sentiment_cache_hits', engine.hits - hits)
+    metrics.count('sentiment_cache_misses', engine.misses - misses)
+    return scores
+
+
+def convert_timestamp_to_int(post: dict) -> dict:
+    '''datetime object are not serializable for json,
+    so we need to convert them to unix timestamp'''
+    post = post.copy()
+    post['timestamp'] = post['timestamp'].timestamp()
+    return post
+
+
+def convert_int_to_timestamp(post: dict) -> dict:
+    # back from the json records of the archive or of the dead-letter spool
+    post = post.copy()
+    post['timestamp'] = datetime.fromtimestamp(post['timestamp'], tz=pytz.UTC)
+    return post
+
+
+def with_retries(function: Callable[..., Any], *args,
+                 attempts: int = SINK_ATTEMPTS,
+                 base_delay: float = 0.5,
+                 max_delay: float = 8.0,
+                 description: str = '') -> Any:
+    '''
+    call `function` until it works, at most `attempts` times.
+    The waits double each time and are random ("full jitter") so that
+    concurrent sinks and lambdas do not all retry at the same moment
+    '''
+    for attempt in range(attempts):
+        try:
+            return function(*args)
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+            metrics.count('retries')
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            logging.warning(f'{description} failed ({e}), retry {attempt + 1} in {delay:.2f}s')
+            time.sleep(delay)
+
+
+def insert_data_in_db(df: pd.DataFrame,
+                      conn: psycopg2.extensions.connection,
+                      table_name: str,
+                      on_conflict: str = 'nothing') -> LoadResult:
+    '''
+    bulk load the rows, rows already stored are skipped (or updated)
+    so re-running the same batch is harmless
+    '''
+    # you need data and a valid connection to insert data in DB
+    if conn is None:
+        raise ValueError('Connection to DB must be alive!')
+    if len(df) == 0:
+        raise ValueError('df has 0 rows!')
+    try:
+        result = bulk_upsert(df, conn, table_name=table_name, on_conflict=on_conflict)
+    except Exception as e:
+        logging.exception(f'FAILED  {str(e)}')
+        raise
+    # one line per chunk, the totals are in the metrics and in the summary of the run
+    logging.debug(f'{table_name}: {result.inserted} inserted, {result.updated} updated, '
+                  f'{result.skipped} skipped')
+    return result
+
+
+# stages, each one gives an iterator of chunks and times only its own work
+
+def fetch_stage(posts: Iterable[dict], chunk_size: int) -> Iterator[List[dict]]:
+    chunks = chunked(posts, chunk_size)
+    while True:
+        # the source downloads and filters while the chunk is filled
+        with metrics.timer('fetch'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        metrics.count('posts_new', len(chunk))
+        yield chunk
+
+
+def extract_stage(chunks: Iterable[List[dict]],
+                  extract: Callable[[dict], dict]) -> Iterator[List[dict]]:
+    for chunk in chunks:
+        with metrics.timer('extract'):
+            rows = [extract(post) for post in chunk]
+        yield rows
+
+
+def score_stage(chunks: Iterable[List[dict]]) -> Iterator[List[dict]]:
+    for chunk in chunks:
+        with metrics.timer('score'):
+            add_sentiment_scores(chunk)
+        yield chunk
+
+
+class Sink:
+    '''
+    stores the scored rows, `write` is called for every chunk and `close` at the end.
+    `write` can be called again with the same rows after a failure
+    '''
+    name = 'sink'
+
+    def write(self, rows: List[dict]) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class ArchiveSink(Sink):
+    '''
+    one gzip'd NDJSON object of raw messages per chunk, under the prefix of the table
+    '''
+    name = 'archive'
+
+    def __init__(self, bucket: str, table_name: str):
+        self.bucket = bucket
+        self.table_name = table_name
+        self.keys: List[str] = []
+
+    @metrics.timed('s3_upload')
+    def write(self, rows: List[dict]) -> None:
+        key = upload_records((convert_timestamp_to_int(row) for row in rows),
+                             bucket=self.bucket, prefix=table_prefix(self.table_name))
+        self.keys.append(key)
+        logging.debug(f'archived to s3://{self.bucket}/{key}')
+
+
+class DbSink(Sink):
+    '''
+    bulk load every chunk in the table, the rollups of the dashboard
+    are refreshed once at the end from the oldest row written.
+    Rows already stored count too: if the refresh of a previous run failed,
+    its posts are fetched again and skipped by the insert, but their buckets
+    still have to be refreshed
+    '''
+    name = 'db'
+
+    def __init__(self, table_name: str, on_conflict: str = 'nothing'):
+        self.table_name = table_name
+        self.on_conflict = on_conflict
+        self.result = LoadResult(0, 0, 0)
+        self._written_since: Optional[datetime] = None
+
+    @metrics.timed('db_insert')
+    def write(self, rows: List[dict]) -> None:
+        import pandas as pd
+
+        df = pd.DataFrame(rows)
+        with db_connection() as conn:
+            # the rows carry more fields than the table, i.e. the post id kept in the archive
+            # or the model version when the table has no column for it
+            columns = table_columns(conn, self.table_name)
+            df = df[[column for column in df.columns if column in columns]]
+            result = insert_data_in_db(df=df, conn=conn, table_name=self.table_name,
+                                       on_conflict=self.on_conflict)
+        self.result = LoadResult(*(total + part for total, part in zip(self.result, result)))
+        for name, value in result._asdict().items():
+            metrics.count(f'rows_{name}', value)
+        oldest = df['timestamp'].min().to_pydatetime()
+        if self._written_since is None or oldest < self._written_since:
+            self._written_since = oldest
+
+    def close(self) -> None:
+        if self._written_since is not None:
+            with db_connection() as conn, metrics.timer('rollups'):
+                # keep the dashboard rollups up to date with the new posts
+                refresh_rollups(conn, self.table_name, since=self._written_since)
+
+
+def make_sink(name: str, table_name: str, bucket: str) -> Sink:
+    if name == ArchiveSink.name:
+        return ArchiveSink(bucket, table_name)
+    if name == DbSink.name:
+        return DbSink(table_name)
+    raise ValueError(f'unknown sink {name}')
+
+
+def default_sinks(source: Source) -> List[Sink]:
+    bucket = os.environ['S3_BUCKET_NAME']
+    return [make_sink(ArchiveSink.name, source.table_name, bucket),
+            make_sink(DbSink.name, source.table_name, bucket)]
+
+
+class SinkRunner:
+    '''
+    Write the chunks to one sink in its own thread, so the sinks work at the same
+    time and while the next chunk is fetched. At most `max_pending` chunks wait for
+    the sink. A chunk still failing after the retries goes to the dead-letter spool
+    '''
+
+    def __init__(self, sink: Sink, table_name: str, bucket: str, max_pending: int = 2):
+        self.sink = sink
+        self.table_name = table_name
+        self.bucket = bucket
+        self.max_pending = max_pending
+        self.dead_letters = 0
+        # False once a chunk is spooled only in /tmp, it is lost if the container goes
+        self.durable = True
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{sink.name}-sink')
+
+    def _write(self, rows: List[dict]) -> None:
+        description = f'{self.sink.name} sink of {self.table_name}'
+        try:
+            with_retries(self.sink.write, rows, description=description)
+        except Exception:
+            logging.exception(f'{description} gave up, {len(rows)} rows go to the dead-letter spool')
+            self.dead_letters += 1
+            metrics.count('dead_letters')
+            records = [convert_timestamp_to_int(row) for row in rows]
+            if not dead_letter.spool(self.sink.name, self.table_name, records, self.bucket):
+                self.durable = False
+
+    def submit(self, rows: List[dict]) -> None:
+        while len(self._pending) >= self.max_pending:
+            self._pending.popleft().result()
+        self._pending.append(self._executor.submit(self._write, rows))
+
+    def close(self) -> None:
+        try:
+            while self._pending:
+                self._pending.popleft().result()
+        finally:
+            self._executor.shutdown()
+        with_retries(self.sink.close, description=f'closing the {self.sink.name} sink of {self.table_name}')
+
+
+def is_unavailable(error: Exception) -> bool:
+    '''
+    the sink cannot be reached (DB or network down), unlike an error of the rows
+    (i.e. a text too long for the column) that would fail again anyway
+    '''
+    import psycopg2
+    from botocore.exceptions import ConnectionError as S3ConnectionError
+
+    return isinstance(error, (ConnectionError, psycopg2.OperationalError,
+                              psycopg2.InterfaceError, S3ConnectionError))
+
+
+def drain_dead_letters(bucket: str) -> int:
+    '''
+    store the chunks spooled by the previous runs. A sink that cannot be reached
+    keeps all its chunks for the next run, a chunk failing for another reason
+    is counted and, after a few runs, quarantined so it does not block the others.
+    Return the number of chunks stored
+    '''
+    sinks = {}
+    failing = set()
+    drained = 0
+    for letter in dead_letter.pending(bucket):
+        target = (letter.sink, letter.table_name)
+        if target in failing:
+            continue
+        if target not in sinks:
+            sinks[target] = make_sink(letter.sink, letter.table_name, bucket)
+        try:
+            rows = [convert_int_to_timestamp(record) for record in dead_letter.read(letter, bucket)]
+            with_retries(sinks[target].write, rows, description=f'dead letter {letter.key}')
+            dead_letter.remove(letter, bucket)
+        except Exception as e:
+            if is_unavailable(e):
+                logging.exception(f'the {letter.sink} sink of {letter.table_name} is unavailable, '
+                                  'its dead letters are kept for the next run')
+                failing.add(target)
+                continue
+            logging.exception(f'dead letter {letter.key} cannot be stored')
+            try:
+                letter = dead_letter.record_failure(letter, bucket)
+            except Exception:
+                logging.exception(f'the failure of dead letter {letter.key} cannot be counted')
+                continue
+            if letter.attempts >= dead_letter.MAX_ATTEMPTS:
+                metrics.count('dead_letters_quarantined')
+            continue
+        drained += 1
+        metrics.count('dead_letters_drained')
+    for target, sink in sinks.items():
+        try:
+            sink.close()
+        except Exception:
+            logging.exception(f'closing the {target[0]} sink of {target[1]} failed')
+    if drained:
+        print(f'{drained} dead-letter chunks stored')
+    return drained
+
+
+class PipelineResult(NamedTuple):
+    source: str
+    rows: int
+    chunks: int
+    dead_letters: int
+
+
+def run_pipeline(source: Source,
+                 sinks: List[Sink],
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 bucket: Optional[str] = None,
+                 dedup_size: int = DEDUP_INDEX_SIZE) -> PipelineResult:
+    '''
+    stream the new posts of `source` through the stages into every sink,
+    the posts in the dedup index of the previous runs are dropped first.
+    The source position and the index are saved only once every chunk is
+    stored or safely in the dead-letter spool on S3, otherwise the next run
+    fetches the same posts again (the DB skips the rows it already has)
+    '''
+    bucket = bucket or os.environ['S3_BUCKET_NAME']
+    with db_connection() as conn:
+        source.open(conn)
+    posts = source.posts()
+    index = load_index(bucket, source.name, dedup_size) if dedup_size else None
+    if index is not None:
+        posts = index.filter_new(posts, source.post_key)
+    runners = [SinkRunner(sink, source.table_name, bucket) for sink in sinks]
+    rows = chunks = 0
+    try:
+        for chunk in score_stage(extract_stage(fetch_stage(posts, chunk_size), source.extract)):
+            for runner in runners:
+                runner.submit(chunk)
+            rows += len(chunk)
+            chunks += 1
+            metrics.count('chunks')
+    finally:
+        # the chunks already given to the sinks are stored even if fetching failed
+        for runner in runners:
+            runner.close()
+    dead_letters = sum(runner.dead_letters for runner in runners)
+    if all(runner.durable for runner in runners):
+        # only now the posts are safe, a crash before this line re-ingests them
+        # and the insert skips the ones already stored.
+        # The position can move even without rows, i.e. when all the posts were duplicates
+        with db_connection() as conn:
+            source.commit(conn)
+        if rows and index is not None:
+            save_index(bucket, source.name, index)
+    else:
+        logging.warning(f'{source.name}: some chunks are only spooled in /tmp, '
+                        'the same posts will be fetched again')
+    if not rows:
+        print(f'{source.name}: no new posts since the last run')
+        return PipelineResult(source.name, 0, 0, 0)
+    print(f'{source.name}: {rows} posts in {chunks} chunks ({dead_letters} dead letters), '
+          f'sentiment cache: {engine.stats()}')
+    return PipelineResult(source.name, rows, chunks, dead_letters)
+
+
+def run_sources(sources: List[Source],
+                make_sinks: Callable[[Source], List[Sink]] = default_sinks,
+                chunk_size: int = DEFAULT_CHUNK_SIZE,
+                bucket: Optional[str] = None) -> List[PipelineResult]:
+    '''
+    store what the previous runs left in the dead-letter spool, then run
+    the pipeline of every source at the same time, each with its own sinks.
+    A failing source is logged and does not stop the others
+    '''
+    bucket = bucket or os.environ['S3_BUCKET_NAME']
+    with metrics.timer('drain_dead_letters'):
+        drain_dead_letters(bucket)
+    if len(sources) == 1:
+        return [run_pipeline(sources[0], make_sinks(sources[0]), chunk_size, bucket)]
+    results = []
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = [executor.submit(run_pipeline, source, make_sinks(source), chunk_size, bucket)
+                   for source in sources]
+        for source, future in zip(sources, futures):
+            try:
+                results.append(future.result())
+            except Exception:
+                logging.exception(f'{source.name} failed')
+    return results
+
+
+def make_source(name: str) -> Source:
+    # each lambda module gives its adapter, only the ones used are imported
+    if name == 'guardian':
+        from lambda_.lambda_function_guardian import make_source as make_guardian_source
+        return make_guardian_source()
+    if name == 'twitter':
+        from lambda_.lambda_function import make_source as make_twitter_source
+        return make_twitter_source()
+    raise ValueError(f'unknown source {name}, use guardian or twitter')
+
+
+def pipeline_handler(event, context):
+    metrics.reset()
+    try:
+        # wrap the body into a try/catch to avoid lambda automatically re-trying
+        with metrics.timer('invocation'):
+            names = os.environ.get('PIPELINE_SOURCES', 'guardian').split(',')
+            sources = [make_source(name.strip()) for name in names if name.strip()]
+            run_sources(sources, chunk_size=int(os.environ.get('PIPELINE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)))
+    except Exception as e:
+        metrics.count('errors')
+        logging.exception('Exception occured \n')
+    metrics.flush(function='pipeline')
+    print('Lambda executed succesfully!')
+
+
+if __name__ == "__main__":
+    pipeline_handler({}, {})
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Rebuild an analytics table from the raw-messages archive, i.e. after losing
+the RDS table or changing its schema. Run it from the `src` folder with
+    python -m lambda_.replay --bucket my-bucket --table tweets_analytics \
+        --start 2021-11-01 --end 2021-11-30
+
+Objects are downloaded and parsed by a few threads, with a bounded number
+in flight so memory stays flat, and loaded in batches with the bulk loader.
+After every batch the last loaded key is saved in a checkpoint file,
+running the same command again resumes from there (another range or table starts over).
+Only the objects archived for the table are read; the older objects did
+not say where their records came from, tweets are told from guardian
+posts by their author
+"""
+
+from __future__ import annotations
+
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import json
+import os
+import time
+from typing import TYPE_CHECKING, Iterator, List, Optional
+
+from lambda_.archive import RAW_PREFIX, list_objects, read_records, table_prefix
+from lambda_.db import LoadResult, bulk_upsert, db_connection
+from lambda_.lambda_function import TABLE_NAME as TWITTER_TABLE
+from lambda_.lambda_function_guardian import GUARDIAN_AUTHOR, TABLE_NAME as GUARDIAN_TABLE, post_author
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+TABLE_COLUMNS = ['author', 'timestamp', 'text', 'sentiment_score']
+
+
+def archive_keys(bucket: str, table_name: str, start: date, end: date,
+                 prefix: str = RAW_PREFIX) -> Iterator[str]:
+    '''
+    keys of the objects archived from `start` to `end` (both included) for the table, day by day.
+    Older runs wrote the records of every table under flat keys like
+    raw-messages/15-11-2021-11:25:19.json or raw-messages/dt=2021-11-15/hour=11/...,
+    newer ones raw-messages/<table>/dt=2021-11-15/hour=11/...
+    '''
+    day = start
+    while day <= end:
+        for day_prefix in (f'{prefix}/{day:%d-%m-%Y}', f'{prefix}/dt={day:%Y-%m-%d}/',
+                           f'{table_prefix(table_name, prefix)}/dt={day:%Y-%m-%d}/'):
+            for obj in list_objects(bucket, day_prefix):
+                yield obj['Key']
+        day += timedelta(days=1)
+
+
+def legacy_table(record: dict) -> str:
+    # in the objects without table in the key, only tweets have an author
+    return TWITTER_TABLE if record.get('author') else GUARDIAN_TABLE
+
+
+def read_table_records(bucket: str, key: str, table_name: str,
+                       prefix: str = RAW_PREFIX) -> List[dict]:
+    '''
+    the records of the object that belong to the table
+    '''
+    records = read_records(bucket, key)
+    if not key.startswith(f'{table_prefix(table_name, prefix)}/'):
+        records = [record for record in records if legacy_table(record) == table_name]
+    if table_name == GUARDIAN_TABLE:
+        # archived before guardian posts were given an author, or the same one for all of them
+        for record in records:
+            record['author'] = post_author(record['post_id']) if record.get('post_id') else GUARDIAN_AUTHOR
+    return records
+
+
+def records_to_frame(records: List[dict]) -> pd.DataFrame:
+    import pandas as pd
+
+    df = pd.DataFrame.from_records(records)
+    df = df[[column for column in TABLE_COLUMNS if column in df.columns]]
+    # the archive stores unix timestamps
+    df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s', utc=True)
+    return df
+
+
+class Checkpoint:
+    '''
+    last key loaded in the table, saved in a small json file together with
+    the replay it belongs to (bucket, table, range and prefix). The checkpoint
+    of another replay is ignored, its last key would not be in the listing
+    '''
+
+    def __init__(self, path: str, run: dict):
+        self.path = path
+        self.run = run
+        self.last_key: Optional[str] = None
+        if os.path.exists(path):
+            with open(path) as fin:
+                saved = json.load(fin)
+            if saved.get('run') == run:
+                self.last_key = saved.get('last_key')
+            else:
+                print(f'{path} is the checkpoint of another replay ({saved.get("run")}), '
+                      'starting from the beginning')
+
+    def save(self, last_key: str) -> None:
+        # write and rename so an interruption never leaves a broken file
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as fout:
+            json.dump(dict(run=self.run, last_key=last_key), fout)
+        os.replace(tmp_path, self.path)
+        self.last_key = last_key
+
+
+def _skip_done(keys: Iterator[str], last_key: Optional[str]) -> Iterator[str]:
+    # the keys come always in the same order, skip up to the checkpoint
+    if last_key is None:
+        yield from keys
+        return
+    found = False
+    for key in keys:
+        if found:
+            yield key
+        elif key == last_key:
+            found = True
+    if not found:
+        # skipping everything would look like a finished replay
+        raise ValueError(f'the checkpoint key {last_key} is not in the archive anymore, '
+                         'delete the checkpoint file to replay the whole range')
+
+
+def replay(bucket: str,
+           table_name: str,
+           start: date,
+           end: date,
+           checkpoint_path: str,
+           workers: int = 8,
+           batch_rows: int = 20000,
+           on_conflict: str = 'nothing',
+           report_every: float = 10.0) -> LoadResult:
+    import pandas as pd
+
+    checkpoint = Checkpoint(checkpoint_path, dict(bucket=bucket, table=table_name, start=start.isoformat(),
+                                                  end=end.isoformat(), prefix=RAW_PREFIX))
+    if checkpoint.last_key:
+        print(f'resuming after {checkpoint.last_key}')
+    keys = _skip_done(archive_keys(bucket, table_name, start, end), checkpoint.last_key)
+    totals = LoadResult(0, 0, 0)
+    started = last_report = time.monotonic()
+    objects = rows = 0
+    frames, frame_rows, last_key = [], 0, None
+
+    def flush() -> None:
+        nonlocal frames, frame_rows, totals
+        df = pd.concat(frames, ignore_index=True)
+        with db_connection() as conn:
+            result = bulk_upsert(df, conn, table_name=table_name, on_conflict=on_conflict)
+        totals = LoadResult(*(total + part for total, part in zip(totals, result)))
+        # every key up to last_key is now in the table
+        checkpoint.save(last_key)
+        frames, frame_rows = [], 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+
+        def submit_next() -> None:
+            key = next(keys, None)
+            if key is not None:
+                in_flight.append((key, executor.submit(read_table_records, bucket, key, table_name)))
+
+        # at most 2 downloads per worker are in flight, consumed in key order
+        for _ in range(2 * workers):
+            submit_next()
+        while in_flight:
+            key, future = in_flight.popleft()
+            submit_next()
+            records = future.result()
+            objects += 1
+            last_key = key
+            if records:
+                frames.append(records_to_frame(records))
+                frame_rows += len(records)
+                rows += len(records)
+            if frame_rows >= batch_rows:
+                flush()
+            now = time.monotonic()
+            if now - last_report >= report_every:
+                print(f'{objects} objects, {rows} rows, {rows / (now - started):.0f} rows/s, '
+                      f'last key {last_key}')
+                last_report = now
+        if frames:
+            flush()
+        elif last_key is not None:
+            checkpoint.save(last_key)
+
+    elapsed = time.monotonic() - started
+    print(f'done: {objects} objects, {rows} rows in {elapsed:.1f}s '
+          f'({rows / elapsed if elapsed else 0:.0f} rows/s), {totals.inserted} inserted, '
+          f'{totals.updated} updated, {totals.skipped} skipped')
+    return totals
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='rebuild a table from the raw-messages archive')
+    arg_parser.add_argument('--bucket', default=os.environ.get('S3_BUCKET_NAME'))
+    arg_parser.add_argument('--table', required=True,
+                            help='i.e. tweets_analytics or guardian_posts_analytics')
+    arg_parser.add_argument('--start', required=True, type=date.fromisoformat)
+    arg_parser.add_argument('--end', required=True, type=date.fromisoformat)
+    arg_parser.add_argument('--checkpoint', default=None,
+                            help='default replay-<table>.json in the current folder')
+    arg_parser.add_argument('--workers', type=int, default=8)
+    arg_parser.add_argument('--batch-rows', type=int, default=20000)
+    arg_parser.add_argument('--on-conflict', choices=['nothing', 'update'], default='nothing')
+    args = arg_parser.parse_args()
+    replay(bucket=args.bucket, table_name=args.table, start=args.start, end=args.end,
+           checkpoint_path=args.checkpoint or f'replay-{args.table}.json',
+           workers=args.workers, batch_rows=args.batch_rows,
+           on_conflict=args.on_conflict)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Score again the rows of an analytics table after a change of the sentiment
+formula or of the VADER lexicon. Run it from the `src` folder with
+    python -m lambda_.rescore --table tweets_analytics --workers 8
+
+The rows are streamed from a server side cursor, scored by a pool of
+processes (one per core by default) and written back in batches together
+with the model version (lambda_.sentiment engine.version) in the
+sentiment_model_version column. Only rows with another version are read,
+so an interrupted run continues where it stopped when started again.
+The rows are written back by the primary key of the table (--key-columns
+for a table without one). The rollups of the rescored range are refreshed at the end
+"""
+
+from __future__ import annotations
+
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import os
+import time
+from typing import TYPE_CHECKING, List, Optional, Sequence, Tuple
+
+from lambda_.db import db_connection, primary_key
+from lambda_.rollups import refresh_rollups
+from lambda_.sentiment import VERSION_COLUMN, engine
+
+if TYPE_CHECKING:
+    import psycopg2
+
+
+def ensure_version_column(conn: psycopg2.extensions.connection, table_name: str) -> None:
+    with conn.cursor() as cur:
+        cur.execute(f'ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {VERSION_COLUMN} varchar(40)')
+    conn.commit()
+
+
+def score_texts(texts: List[str]) -> Tuple[List[float], str]:
+    # runs in the worker processes, each one loads its own analyzer once
+    return engine.score_many(texts).tolist(), engine.version
+
+
+def write_scores(conn: psycopg2.extensions.connection,
+                 table_name: str,
+                 key_columns: Sequence[str],
+                 rows: List[tuple]) -> None:
+    '''
+    rows are (*key, score, version), one UPDATE joined with a VALUES list per page
+    '''
+    from psycopg2.extras import execute_values
+
+    keys = ', '.join(key_columns)
+    join = ' AND '.join(f't.{column} = v.{column}' for column in key_columns)
+    with conn.cursor() as cur:
+        execute_values(cur, f"""UPDATE {table_name} AS t
+                                SET sentiment_score = v.score, {VERSION_COLUMN} = v.version
+                                FROM (VALUES %s) AS v({keys}, score, version)
+                                WHERE {join}""", rows, page_size=1000)
+    conn.commit()
+
+
+def rescore(table_name: str,
+            workers: Optional[int] = None,
+            batch_rows: int = 5000,
+            key_columns: Optional[Sequence[str]] = None,
+            since: Optional[datetime] = None,
+            report_every: float = 10.0) -> int:
+    '''
+    rescore the rows of `table_name`, identified by `key_columns` (by default its primary key)
+    '''
+    workers = workers or os.cpu_count() or 1
+    version = engine.version
+    condition = f'{VERSION_COLUMN} IS DISTINCT FROM %s AND text IS NOT NULL'
+    params = [version]
+    if since is not None:
+        condition += ' AND timestamp >= %s'
+        params.append(since)
+    rows = 0
+    oldest = None
+    started = last_report = time.monotonic()
+
+    with db_connection() as read_conn, db_connection() as write_conn:
+        key_columns = list(key_columns or primary_key(write_conn, table_name))
+        if not key_columns:
+            raise ValueError(f'{table_name} has no primary key, give the columns identifying a row')
+        ensure_version_column(write_conn, table_name)
+        # a named cursor keeps the result on the server, only batch_rows rows are in memory
+        with read_conn.cursor(name=f'rescore_{table_name}') as cur, \
+                ProcessPoolExecutor(max_workers=workers) as executor:
+            cur.itersize = batch_rows
+            cur.execute(f"""SELECT {', '.join(key_columns)}, text FROM {table_name}
+                            WHERE {condition}""", params)
+            in_flight = deque()
+
+            def submit_next() -> bool:
+                batch = cur.fetchmany(batch_rows)
+                if batch:
+                    keys = [row[:-1] for row in batch]
+                    in_flight.append((keys, executor.submit(score_texts, [row[-1] for row in batch])))
+                return bool(batch)
+
+            # two batches per worker are scored while the results are written
+            for _ in range(2 * workers):
+                if not submit_next():
+                    break
+            while in_flight:
+                keys, future = in_flight.popleft()
+                submit_next()
+                scores, worker_version = future.result()
+                if worker_version != version:
+                    raise RuntimeError(f'a worker scores with {worker_version} instead of {version}, '
+                                       'is VADER_LEXICON_SNAPSHOT the same everywhere?')
+                write_scores(write_conn, table_name, key_columns,
+                             [(*key, score, version) for key, score in zip(keys, scores)])
+                rows += len(keys)
+                if 'timestamp' in key_columns:
+                    batch_oldest = min(key[key_columns.index('timestamp')] for key in keys)
+                    oldest = batch_oldest if oldest is None else min(oldest, batch_oldest)
+                now = time.monotonic()
+                if now - last_report >= report_every:
+                    print(f'{rows} rows rescored, {rows / (now - started):.0f} rows/s')
+                    last_report = now
+        read_conn.commit()
+        if oldest is not None:
+            # the mean scores of the charts changed too
+            refresh_rollups(write_conn, table_name, since=oldest)
+
+    elapsed = time.monotonic() - started
+    print(f'done: {rows} rows of {table_name} rescored with {version} in {elapsed:.1f}s '
+          f'({rows / elapsed if elapsed else 0:.0f} rows/s)')
+    return rows
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='score again the rows of a table')
+    arg_parser.add_argument('--table', required=True,
+                            help='i.e. tweets_analytics or guardian_posts_analytics')
+    arg_parser.add_argument('--workers', type=int, default=None, help='default one per core')
+    arg_parser.add_argument('--batch-rows', type=int, default=5000)
+    arg_parser.add_argument('--key-columns', default=None,
+                            help='columns identifying a row, i.e. author,timestamp (default the primary key)')
+    arg_parser.add_argument('--since', type=datetime.fromisoformat, default=None,
+                            help='only the rows from this date, i.e. 2021-11-01')
+    args = arg_parser.parse_args()
+    key_columns = args.key_columns.split(',') if args.key_columns else None
+    rescore(args.table, workers=args.workers, batch_rows=args.batch_rows,
+            key_columns=key_columns, since=args.since)
+
+
+if __name__ == "__main__":
+    main()
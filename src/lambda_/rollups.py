@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sentiment score rollups per minute, hour and day (count, sum, min and max)
+kept in the sentiment_rollups table for the dashboard charts.
+At the end of each run the lambda functions recompute every bucket from the
+oldest row they wrote up to now, a whole range can be rebuilt from the `src` folder with
+    python -m lambda_.rollups --table tweets_analytics --since 2021-01-01
+"""
+
+from __future__ import annotations
+
+import argparse
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Optional
+
+import pytz
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import psycopg2
+
+
+ROLLUP_TABLE = 'sentiment_rollups'
+
+CREATE_ROLLUP_TABLE = f"""
+CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE}(
+    source_table varchar(63),
+    resolution varchar(10),
+    bucket timestamp with time zone,
+    n integer NOT NULL,
+    sum_score double precision NOT NULL,
+    min_score double precision NOT NULL,
+    max_score double precision NOT NULL,
+    PRIMARY KEY(source_table, resolution, bucket)
+    )
+"""
+
+# from the finest to the coarsest
+RESOLUTIONS = {'minute': timedelta(minutes=1),
+               'hour': timedelta(hours=1),
+               'day': timedelta(days=1)}
+
+_table_checked = False
+
+
+def _ensure_table(conn: psycopg2.extensions.connection) -> None:
+    global _table_checked
+    if not _table_checked:
+        with conn.cursor() as cur:
+            cur.execute(CREATE_ROLLUP_TABLE)
+        conn.commit()
+        _table_checked = True
+
+
+def refresh_rollups(conn: psycopg2.extensions.connection,
+                    table_name: str,
+                    since: datetime,
+                    until: Optional[datetime] = None) -> None:
+    '''
+    recompute from `table_name` every bucket between `since` and `until`,
+    whole buckets are recomputed so running it twice gives the same result
+    '''
+    _ensure_table(conn)
+    until_filter = "AND timestamp <= %(until)s" if until is not None else ""
+    with conn.cursor() as cur:
+        for resolution in RESOLUTIONS:
+            # buckets are in UTC whatever the time zone of the DB session
+            cur.execute(f"""
+                INSERT INTO {ROLLUP_TABLE}
+                    (source_table, resolution, bucket, n, sum_score, min_score, max_score)
+                SELECT %(table)s, %(resolution)s,
+                       date_trunc(%(resolution)s, timestamp AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+                       count(*), sum(sentiment_score), min(sentiment_score), max(sentiment_score)
+                FROM {table_name}
+                WHERE timestamp >= date_trunc(%(resolution)s, %(since)s AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'
+                  AND sentiment_score IS NOT NULL
+                  {until_filter}
+                GROUP BY 3
+                ON CONFLICT (source_table, resolution, bucket) DO UPDATE
+                SET n = EXCLUDED.n,
+                    sum_score = EXCLUDED.sum_score,
+                    min_score = EXCLUDED.min_score,
+                    max_score = EXCLUDED.max_score
+                """, dict(table=table_name, resolution=resolution, since=since, until=until))
+    conn.commit()
+
+
+def choose_resolution(start: datetime, end: datetime, max_buckets: int) -> str:
+    '''
+    the finest resolution giving at most `max_buckets` buckets in the range
+    '''
+    for resolution, width in RESOLUTIONS.items():
+        if (end - start) / width <= max_buckets:
+            return resolution
+    return 'day'
+
+
+def read_rollups(conn: psycopg2.extensions.connection,
+                 table_name: str,
+                 resolution: str,
+                 start: datetime,
+                 end: datetime) -> pd.DataFrame:
+    import pandas as pd
+
+    sql = f"""SELECT bucket, n, sum_score, min_score, max_score FROM {ROLLUP_TABLE}
+              WHERE source_table = %s AND resolution = %s
+                AND bucket >= %s AND bucket <= %s
+              ORDER BY bucket"""
+    return pd.read_sql_query(sql, conn, params=[table_name, resolution, start, end])
+
+
+def downsample(df: pd.DataFrame, max_points: int) -> pd.DataFrame:
+    '''
+    merge consecutive buckets (bucket, n, sum_score, min_score, max_score)
+    so that at most `max_points` are left, the mean is weighted by the counts.
+    The index is in UTC, even when there are no buckets
+    '''
+    import numpy as np
+    import pandas as pd
+
+    if len(df) > max_points:
+        group = np.arange(len(df)) * max_points // len(df)
+        df = df.groupby(group).agg(bucket=('bucket', 'first'), n=('n', 'sum'),
+                                   sum_score=('sum_score', 'sum'),
+                                   min_score=('min_score', 'min'),
+                                   max_score=('max_score', 'max'))
+    return pd.DataFrame({'count': df['n'].to_numpy(),
+                         'sentiment_score': (df['sum_score'] / df['n']).to_numpy(),
+                         'min': df['min_score'].to_numpy(),
+                         'max': df['max_score'].to_numpy()},
+                        index=pd.DatetimeIndex(pd.to_datetime(df['bucket'], utc=True),
+                                               name='timestamp'))
+
+
+def main() -> None:
+    from lambda_.db import db_connection
+
+    arg_parser = argparse.ArgumentParser(description='rebuild the sentiment rollups of a table')
+    arg_parser.add_argument('--table', required=True)
+    arg_parser.add_argument('--since', required=True, type=datetime.fromisoformat,
+                            help='i.e. 2021-01-01, rollups are rebuilt from here to now')
+    args = arg_parser.parse_args()
+    since = args.since if args.since.tzinfo else pytz.UTC.localize(args.since)
+    with db_connection() as conn:
+        refresh_rollups(conn, args.table, since=since)
+    print(f'rollups of {args.table} refreshed since {since}')
+
+
+if __name__ == "__main__":
+    main()
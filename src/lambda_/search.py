@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Full text search on the text of the posts.
+A generated tsvector column, filled by Postgres at insert time, is indexed
+with GIN so keyword lookups do not scan the table. Add it once (Postgres 12+)
+from the `src` folder with
+    python -m lambda_.search --table tweets_analytics
+"""
+
+from __future__ import annotations
+
+import argparse
+import re
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import psycopg2
+
+
+SEARCH_COLUMN = 'text_search'
+# no stemming, headlines mix names and languages
+SEARCH_CONFIG = 'simple'
+
+_WORD = re.compile(r'\w+')
+
+
+def search_index_ddl(table_name: str) -> str:
+    return f"""
+ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {SEARCH_COLUMN} tsvector
+    GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', coalesce(text, ''))) STORED;
+CREATE INDEX IF NOT EXISTS {table_name}_{SEARCH_COLUMN}_idx
+    ON {table_name} USING GIN ({SEARCH_COLUMN});
+"""
+
+
+def to_prefix_tsquery(keyword: str) -> str:
+    '''
+    'Climate chan' -> 'climate:* & chan:*', every word must be there
+    and it can be the beginning of a longer word.
+    Only letters and digits are kept so the user cannot write tsquery syntax
+    '''
+    return ' & '.join(f'{word}:*' for word in _WORD.findall(keyword.lower()))
+
+
+def search_condition() -> str:
+    # to be used with the output of to_prefix_tsquery as parameter
+    return f"{SEARCH_COLUMN} @@ to_tsquery('{SEARCH_CONFIG}', %s)"
+
+
+def create_search_index(conn: psycopg2.extensions.connection, table_name: str) -> None:
+    with conn.cursor() as cur:
+        cur.execute(search_index_ddl(table_name))
+    conn.commit()
+
+
+def main() -> None:
+    from lambda_.db import db_connection
+
+    arg_parser = argparse.ArgumentParser(description='add the full text search index to a table')
+    arg_parser.add_argument('--table', required=True)
+    args = arg_parser.parse_args()
+    with db_connection() as conn:
+        create_search_index(conn, args.table)
+    print(f'{args.table} has now a full text search index on {SEARCH_COLUMN}')
+
+
+if __name__ == "__main__":
+    main()
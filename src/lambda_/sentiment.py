@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sentiment scoring engine shared by the lambda functions.
+Texts are scored in batches and the scores are kept in a bounded LRU cache
+so that repeated headlines are never scored twice
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import threading
+from typing import TYPE_CHECKING, Iterable, List, Optional
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from nltk.sentiment import SentimentIntensityAnalyzer
+
+
+# increase it when the formula in SentimentEngine._compute changes,
+# the rows scored with another version can be rescored with lambda_.rescore
+SCORE_VERSION = 1
+# column of the analytics tables with the `engine.version` that gave the score
+VERSION_COLUMN = 'sentiment_model_version'
+
+# pre-parsed lexicon shipped together with the lambda code,
+# create it with `python -m lambda_.sentiment` before zipping the folder
+LEXICON_SNAPSHOT = os.environ.get(
+    'VADER_LEXICON_SNAPSHOT',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vader_lexicon.pickle'))
+
+
+def _analyzer_from_snapshot(path: str) -> SentimentIntensityAnalyzer:
+    '''
+    build the analyzer from the pickled lexicon dictionary,
+    this skips both the download and the parsing of the lexicon text file
+    '''
+    from nltk.sentiment.vader import SentimentIntensityAnalyzer, VaderConstants
+    with open(path, 'rb') as fin:
+        lexicon = pickle.load(fin)
+    sia = SentimentIntensityAnalyzer.__new__(SentimentIntensityAnalyzer)
+    sia.lexicon = lexicon
+    sia.constants = VaderConstants()
+    return sia
+
+
+def _load_analyzer() -> SentimentIntensityAnalyzer:
+    if os.path.exists(LEXICON_SNAPSHOT):
+        return _analyzer_from_snapshot(LEXICON_SNAPSHOT)
+    from nltk.sentiment import SentimentIntensityAnalyzer
+    try:
+        return SentimentIntensityAnalyzer()
+    except LookupError:
+        import nltk
+        # in lambda you can only write to /tmp folder
+        # nltk needs to download data to run a model
+        nltk.download('vader_lexicon', download_dir='/tmp')
+        # nltk will look for the downloaded data to run SentimentIntensityAnalyzer
+        nltk.data.path.append("/tmp")
+        return SentimentIntensityAnalyzer()
+
+
+def dump_lexicon_snapshot(path: str = LEXICON_SNAPSHOT) -> str:
+    '''
+    parse the nltk lexicon once and pickle the resulting dictionary
+    '''
+    from nltk.sentiment import SentimentIntensityAnalyzer
+    lexicon = SentimentIntensityAnalyzer().lexicon
+    with open(path, 'wb') as fout:
+        pickle.dump(lexicon, fout, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def normalize_text(text: str) -> str:
+    '''
+    collapse whitespace so that re-published posts map to the same cache key,
+    the case is kept because VADER scores capital letters as emphasis
+    '''
+    return ' '.join(text.split())
+
+
+class SentimentEngine:
+    '''
+    Score texts between -1 (very negative) and 1 (very positive)
+    keeping the last `max_size` scores in memory
+    '''
+
+    def __init__(self, analyzer: Optional[SentimentIntensityAnalyzer] = None,
+                 max_size: int = 10000):
+        # the analyzer is loaded on the first score to keep the cold start short
+        self._analyzer = analyzer
+        self.max_size = max_size
+        self._version: Optional[str] = None
+        self._cache = OrderedDict()
+        # several sources can score at the same time, scoring holds the GIL anyway
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def analyzer(self) -> SentimentIntensityAnalyzer:
+        if self._analyzer is None:
+            self._analyzer = _load_analyzer()
+        return self._analyzer
+
+    @property
+    def version(self) -> str:
+        '''
+        formula and lexicon giving the scores, i.e. 'vader-1-3f9a1c2b'
+        '''
+        if self._version is None:
+            lexicon = repr(sorted(self.analyzer.lexicon.items())).encode('utf-8')
+            self._version = f'vader-{SCORE_VERSION}-{hashlib.sha1(lexicon).hexdigest()[:8]}'
+        return self._version
+
+    def _compute(self, text: str) -> float:
+        # the analyzer gives a positive and negative score
+        score = self.analyzer.polarity_scores(text)
+        # we want only 1 score so the negative sentiment will be a negative score
+        # and likewise for the positive
+        return score['neg'] * -1 + score['pos']
+
+    def score(self, text: str) -> float:
+        return float(self.score_many([text])[0])
+
+    def score_many(self, texts: Iterable[str]) -> np.ndarray:
+        '''
+        score a list (or a DataFrame column) of texts in one call,
+        the result is aligned with the input and can be used as a column
+        '''
+        keys = [normalize_text(text) for text in texts]
+        with self._lock:
+            return self._score_keys(keys)
+
+    def _score_keys(self, keys: List[str]) -> np.ndarray:
+        scores = np.empty(len(keys), dtype=np.float64)
+        computed = {}
+        for i, key in enumerate(keys):
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                scores[i] = self._cache[key]
+                self.hits += 1
+            elif key in computed:
+                # duplicate inside the same batch
+                scores[i] = computed[key]
+                self.hits += 1
+            else:
+                scores[i] = computed[key] = self._compute(key)
+                self.misses += 1
+        for key, value in computed.items():
+            self._cache[key] = value
+        # evict the least recently used scores
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return scores
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses,
+                    hit_rate=round(self.hit_rate, 4),
+                    cache_size=len(self._cache))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# one engine per container, warm invocations reuse its cache
+engine = SentimentEngine()
+
+
+if __name__ == "__main__":
+    print(f'lexicon snapshot written to {dump_lexicon_snapshot()}')
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parse the dates of the Guardian ('2024-06-10T10:46:19Z') and Twitter
+('Sat Sep 02 14:25:02 +0000 2021') APIs. These fixed formats are read by
+slicing the string, about 20 times faster than dateutil which is only used
+for anything else. `post_time` keeps the parsed date in the post so every
+post is parsed once however many times the pipeline needs its date, and
+`parse_times` does a whole column at once with pandas
+"""
+
+from __future__ import annotations
+
+from datetime import datetime
+from typing import TYPE_CHECKING, Callable, Iterable
+
+import pytz
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+GUARDIAN_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+TWITTER_FORMAT = '%a %b %d %H:%M:%S %z %Y'
+# the parsed date is kept in the raw post under this key
+PARSED_KEY = '_parsed_timestamp'
+
+_MONTHS = {month: number for number, month in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], start=1)}
+
+
+def parse_any_time(value: str) -> datetime:
+    '''
+    slow but accepts anything, dates without time zone are taken as UTC
+    '''
+    from dateutil import parser
+
+    parsed = parser.parse(value)
+    if parsed.tzinfo is None:
+        return pytz.UTC.localize(parsed)
+    return parsed.astimezone(pytz.UTC)
+
+
+def parse_guardian_time(value: str) -> datetime:
+    # '2024-06-10T10:46:19Z'
+    if len(value) == 20 and value[10] == 'T' and value[19] == 'Z':
+        try:
+            return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                            int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                            tzinfo=pytz.UTC)
+        except ValueError:
+            pass
+    return parse_any_time(value)
+
+
+def parse_twitter_time(value: str) -> datetime:
+    # 'Sat Sep 02 14:25:02 +0000 2021', twitter always gives UTC
+    parts = value.split(' ')
+    if len(parts) == 6 and parts[4] == '+0000' and parts[1] in _MONTHS:
+        try:
+            hour, minute, second = parts[3].split(':')
+            return datetime(int(parts[5]), _MONTHS[parts[1]], int(parts[2]),
+                            int(hour), int(minute), int(second), tzinfo=pytz.UTC)
+        except ValueError:
+            pass
+    return parse_any_time(value)
+
+
+def post_time(post: dict, field: str, parse: Callable[[str], datetime]) -> datetime:
+    '''
+    date of the post in `field`, parsed the first time only
+    '''
+    parsed = post.get(PARSED_KEY)
+    if parsed is None:
+        parsed = post[PARSED_KEY] = parse(post[field])
+    return parsed
+
+
+def parse_times(values: Iterable[str], date_format: str = GUARDIAN_FORMAT) -> pd.Series:
+    '''
+    a whole column of dates in `date_format` (i.e. TWITTER_FORMAT) to UTC datetimes,
+    the values in another format are parsed one by one with dateutil
+    '''
+    import pandas as pd
+
+    values = pd.Series(values)
+    parsed = pd.to_datetime(values, format=date_format, utc=True, errors='coerce')
+    failed = parsed.isna() & values.notna()
+    if failed.any():
+        parsed[failed] = pd.to_datetime([parse_any_time(value) for value in values[failed]], utc=True)
+    return parsed
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+High-water mark of what each source already ingested, stored in the DB.
+Every run fetches only what is newer than the mark and moves it forward
+after the rows are saved, so nothing is lost when a run is late or skipped
+"""
+
+from __future__ import annotations
+
+from datetime import datetime
+from typing import TYPE_CHECKING, Iterable, NamedTuple, Optional
+
+if TYPE_CHECKING:
+    import psycopg2
+
+
+WATERMARK_TABLE = 'ingestion_watermarks'
+
+CREATE_WATERMARK_TABLE = f"""
+CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE}(
+    source varchar(50) PRIMARY KEY,
+    last_timestamp timestamp with time zone NOT NULL,
+    last_id varchar(300) NOT NULL,
+    updated_at timestamp with time zone NOT NULL DEFAULT now()
+    )
+"""
+
+_table_checked = False
+
+
+class Watermark(NamedTuple):
+    # publication time and id of the newest post ingested,
+    # the id breaks ties between posts published in the same second
+    timestamp: datetime
+    post_id: str
+
+
+def _ensure_table(conn: psycopg2.extensions.connection) -> None:
+    # only the first invocation of a container pays for this
+    global _table_checked
+    if not _table_checked:
+        with conn.cursor() as cur:
+            cur.execute(CREATE_WATERMARK_TABLE)
+        conn.commit()
+        _table_checked = True
+
+
+def load_watermark(conn: psycopg2.extensions.connection,
+                   source: str) -> Optional[Watermark]:
+    _ensure_table(conn)
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT last_timestamp, last_id FROM {WATERMARK_TABLE} WHERE source = %s',
+                    (source,))
+        row = cur.fetchone()
+    conn.commit()
+    return Watermark(*row) if row else None
+
+
+def save_watermark(conn: psycopg2.extensions.connection,
+                   source: str,
+                   watermark: Watermark) -> None:
+    '''
+    store the new mark, an older mark never overwrites a newer one
+    '''
+    _ensure_table(conn)
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            INSERT INTO {WATERMARK_TABLE} AS mark (source, last_timestamp, last_id)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (source) DO UPDATE
+            SET last_timestamp = EXCLUDED.last_timestamp,
+                last_id = EXCLUDED.last_id,
+                updated_at = now()
+            WHERE (EXCLUDED.last_timestamp, EXCLUDED.last_id)
+                  > (mark.last_timestamp, mark.last_id)
+            """, (source, watermark.timestamp, watermark.post_id))
+    conn.commit()
+
+
+def is_newer(timestamp: datetime, post_id: str,
+             watermark: Optional[Watermark]) -> bool:
+    if watermark is None:
+        return True
+    return (timestamp, post_id) > (watermark.timestamp, watermark.post_id)
+
+
+def advance(watermark: Optional[Watermark],
+            marks: Iterable[Watermark]) -> Optional[Watermark]:
+    '''
+    the newest between the current mark and the posts just ingested
+    '''
+    for mark in marks:
+        if watermark is None or tuple(mark) > tuple(watermark):
+            watermark = mark
+    return watermark
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SQL of the dashboard tables, kept apart from the streamlit page.
+The values are always passed as parameters and never formatted in the sql
+"""
+
+from typing import Optional, Tuple
+
+from lambda_.search import search_condition, to_prefix_tsquery
+
+
+# only the columns shown in the dashboard are read,
+# the author column is always reuters
+DISPLAY_COLUMNS = ['timestamp', 'sentiment_score', 'text']
+
+
+def where_clause(start_date: str,
+                 end_date: str,
+                 keyword: str = '') -> Tuple[str, list]:
+    sql = "where timestamp between date(%s) and date(%s)"
+    params = [start_date, end_date]
+    # the keyword is looked up in the full text search index,
+    # all its words must be there and they can be the beginning of longer words
+    tsquery = to_prefix_tsquery(keyword)
+    if tsquery:
+        sql += f" and {search_condition()}"
+        params.append(tsquery)
+    return sql, params
+
+
+def build_query(start_date: str,
+                end_date: str,
+                keyword: str = '',
+                limit: Optional[int] = None,
+                offset: int = 0,
+                table_name: str = 'tweets_analytics') -> Tuple[str, list]:
+    '''
+    sql and parameters selecting only the rows and columns to display,
+    the values are passed as parameters and never formatted in the sql
+    '''
+    where, params = where_clause(start_date, end_date, keyword)
+    sql = f"""select {', '.join(DISPLAY_COLUMNS)} from {table_name}
+              {where} order by timestamp"""
+    if limit is not None:
+        sql += " limit %s offset %s"
+        params += [limit, offset]
+    return sql, params
+
+
+def build_page_query(start_date: str,
+                     end_date: str,
+                     keyword: str = '',
+                     page_size: int = 100,
+                     after: Optional[Tuple[str, str]] = None,
+                     descending: bool = True,
+                     table_name: str = 'tweets_analytics') -> Tuple[str, list]:
+    '''
+    one page of rows following the last row of the previous page, `after` is its
+    (timestamp, author). Unlike an offset, the timestamp index jumps to any page at once.
+    One more row than the page is read to know if there is a next page
+    '''
+    where, params = where_clause(start_date, end_date, keyword)
+    if after is not None:
+        # (timestamp, author) after the cursor, written so that the timestamp index is used
+        after_timestamp, after_author = after
+        op = '<' if descending else '>'
+        where += f" and timestamp {op}= %s and (timestamp {op} %s or author {op} %s)"
+        params += [after_timestamp, after_timestamp, after_author]
+    direction = 'desc' if descending else 'asc'
+    # the author is needed for the cursor, it is not displayed
+    sql = f"""select {', '.join(DISPLAY_COLUMNS)}, author from {table_name}
+              {where} order by timestamp {direction}, author {direction} limit %s"""
+    params.append(page_size + 1)
+    return sql, params
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pytest
+
+# the lambda code is run from the src folder, i.e. `python -m lambda_.replay`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+
+BUCKET = 'test-bucket'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    '''
+    an empty BUCKET in moto, the client of the lambda code is created inside the mock
+    '''
+    moto = pytest.importorskip('moto')
+    from lambda_.archive import get_s3_client
+
+    monkeypatch.delenv('S3_ENDPOINT_URL', raising=False)
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    mock = moto.mock_aws() if hasattr(moto, 'mock_aws') else moto.mock_s3()
+    with mock:
+        get_s3_client.cache_clear()
+        client = get_s3_client()
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+    get_s3_client.cache_clear()
+
+
+@pytest.fixture
+def pg():
+    '''
+    a connection to the Postgres in TEST_DSN (i.e. postgresql://postgres@localhost/test),
+    the tests needing it are skipped without it
+    '''
+    dsn = os.environ.get('TEST_DSN')
+    if not dsn:
+        pytest.skip('TEST_DSN is not set')
+    import psycopg2
+
+    conn = psycopg2.connect(dsn)
+    yield conn
+    conn.rollback()
+    conn.close()
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta, timezone
+import gzip
+import json
+
+import pytz
+
+from conftest import BUCKET
+from lambda_.archive import (archive_key, list_objects, parse_records, read_records,
+                             serialize_records, table_prefix, upload_records)
+
+
+RECORDS = [{'author': 'guardian', 'timestamp': 1636975519.0, 'text': 'héllo\nworld',
+            'sentiment_score': 0.25, 'post_id': 'p1'},
+           {'author': 'guardian', 'timestamp': 1636975520.0, 'text': 'bye',
+            'sentiment_score': -0.5, 'post_id': 'p2'}]
+
+
+def test_serialize_records_is_gzipped_ndjson():
+    lines = gzip.decompress(serialize_records(RECORDS).getvalue()).splitlines()
+    assert [json.loads(line) for line in lines] == RECORDS
+
+
+def test_parse_records_reads_both_formats():
+    assert parse_records('a/b.json.gz', serialize_records(RECORDS).getvalue()) == RECORDS
+    # objects archived before the NDJSON format
+    assert parse_records('a/b.json', json.dumps(RECORDS).encode('utf-8')) == RECORDS
+
+
+def test_archive_key_is_partitioned_in_utc():
+    when = datetime(2021, 11, 15, 12, 25, 19, tzinfo=timezone(timedelta(hours=1)))
+    key = archive_key(table_prefix('tweets_analytics'), when)
+    assert key.startswith('raw-messages/tweets_analytics/dt=2021-11-15/hour=11/112519-')
+    assert key.endswith('.json.gz')
+    assert key != archive_key(table_prefix('tweets_analytics'), when)
+
+
+def test_upload_and_read_back(s3):
+    now = datetime(2021, 11, 15, 11, 25, 19, tzinfo=pytz.UTC)
+    prefix = table_prefix('guardian_posts_analytics')
+    keys = [upload_records(RECORDS, BUCKET, prefix=prefix, now=now),
+            upload_records(RECORDS[:1], BUCKET, prefix=prefix, now=now + timedelta(hours=1))]
+    upload_records(RECORDS, BUCKET, prefix=table_prefix('tweets_analytics'), now=now)
+    listed = [obj['Key'] for obj in list_objects(BUCKET, f'{prefix}/')]
+    assert listed == sorted(keys)
+    assert read_records(BUCKET, keys[0]) == RECORDS
+    assert read_records(BUCKET, keys[1]) == RECORDS[:1]
+    head = s3.head_object(Bucket=BUCKET, Key=keys[0])
+    assert head['ContentType'] == 'application/x-ndjson'
@@ -0,0 +1,76 @@
+from datetime import date, datetime, timedelta
+import io
+import json
+
+import pytest
+import pytz
+
+from conftest import BUCKET
+from lambda_.archive import table_prefix, upload_records
+from lambda_.compaction import compact_partition, schema
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+
+NOW = datetime(2021, 11, 15, 11, 25, 19, tzinfo=pytz.UTC)
+SECOND = NOW.timestamp()
+
+
+def post(post_id, text, score=0.5, author='guardian:1', timestamp=SECOND):
+    record = dict(author=author, timestamp=timestamp, text=text, sentiment_score=score)
+    if post_id is not None:
+        record['post_id'] = post_id
+    return record
+
+
+def archive(records, table_name='guardian_posts_analytics', now=NOW):
+    upload_records(records, BUCKET, prefix=table_prefix(table_name), now=now)
+
+
+def read_parquet(s3, key):
+    return pq.read_table(io.BytesIO(s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()))
+
+
+def test_compact_partition_drops_the_posts_archived_twice(s3):
+    # two posts of the same second, one archived twice with a new score
+    archive([post('p1', 'first'), post('p2', 'second'), post('p1', 'first', score=0.7)])
+    # archived before the id was kept: told apart by their text
+    archive([post(None, 'legacy', author='guardian', timestamp=SECOND - 60),
+             post(None, 'legacy', author='guardian', timestamp=SECOND - 60),
+             post(None, 'other legacy', author='guardian', timestamp=SECOND - 60)],
+            now=NOW + timedelta(minutes=1))
+    # another table and another hour are not read
+    archive([post('t1', 'a tweet')], table_name='tweets_analytics')
+    archive([post('p3', 'later')], now=NOW + timedelta(hours=1))
+
+    manifest = compact_partition(BUCKET, 'guardian_posts_analytics', date(2021, 11, 15), 11)
+    target = 'compacted/guardian_posts_analytics/dt=2021-11-15/hour=11/'
+    assert manifest['partition'] == target
+    assert manifest['files'] == [f'{target}part-00000.parquet']
+    assert len(manifest['source_keys']) == 2
+    assert (manifest['rows_in'], manifest['rows_out']) == (6, 4)
+    assert manifest['min_timestamp'] == '2021-11-15T11:24:19+00:00'
+    assert manifest['max_timestamp'] == '2021-11-15T11:25:19+00:00'
+    saved = json.loads(s3.get_object(Bucket=BUCKET, Key=f'{target}_manifest.json')['Body'].read())
+    assert saved == manifest
+
+    table = read_parquet(s3, manifest['files'][0])
+    assert table.schema.equals(schema())
+    rows = sorted(table.to_pylist(), key=lambda row: (row['timestamp'], row['text']))
+    assert [(row['post_id'], row['text'], row['sentiment_score']) for row in rows] == [
+        (None, 'legacy', 0.5), (None, 'other legacy', 0.5), ('p1', 'first', 0.7), ('p2', 'second', 0.5)]
+    assert rows[-1]['timestamp'] == NOW
+
+
+def test_compact_a_whole_day(s3):
+    archive([post('p1', 'first')])
+    archive([post('p2', 'later', timestamp=SECOND + 3600)], now=NOW + timedelta(hours=1))
+    manifest = compact_partition(BUCKET, 'guardian_posts_analytics', date(2021, 11, 15))
+    assert manifest['partition'] == 'compacted/guardian_posts_analytics/dt=2021-11-15/'
+    assert manifest['rows_out'] == 2
+    # compacting again overwrites the same file
+    assert compact_partition(BUCKET, 'guardian_posts_analytics', date(2021, 11, 15))['files'] == manifest['files']
+
+
+def test_nothing_to_compact(s3):
+    assert compact_partition(BUCKET, 'tweets_analytics', date(2021, 11, 15), 11) is None
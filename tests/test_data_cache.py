@@ -0,0 +1,132 @@
+import pandas as pd
+import pytest
+
+import data_cache
+from data_cache import DatasetCache
+
+
+def ts(value):
+    value = pd.Timestamp(value)
+    return value if value.tzinfo else value.tz_localize('UTC')
+
+
+class FakeTable:
+    '''
+    rows of the table with the time they were stored, `load` sees only
+    the rows stored before the clock of the test
+    '''
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.rows = []
+        self.queries = []
+
+    def add(self, timestamp, stored_at=None, text=''):
+        timestamp = ts(timestamp)
+        self.rows.append((timestamp, ts(stored_at) if stored_at else timestamp, text or str(timestamp)))
+
+    def load(self, start, end, after=None):
+        self.queries.append((start, end, after))
+        rows = sorted((timestamp, 0.5, text) for timestamp, stored_at, text in self.rows
+                      if start <= timestamp < end and (after is None or timestamp > after)
+                      and stored_at <= self.clock[0])
+        return pd.DataFrame(rows, columns=['timestamp', 'sentiment_score', 'text'])
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [ts('2021-12-01')]
+    monkeypatch.setattr(data_cache, '_now', lambda: now[0])
+    return now
+
+
+def hourly_table(clock, days, per_day=24):
+    table = FakeTable(clock)
+    for timestamp in pd.date_range(ts('2021-11-01'), periods=days * per_day,
+                                   freq=pd.Timedelta(days=1) / per_day):
+        table.add(timestamp)
+    return table
+
+
+def make_cache(table, **kwargs):
+    return DatasetCache(table.load, refresh_seconds=3600, **kwargs)
+
+
+def test_sub_ranges_are_sliced_from_the_cached_days(clock):
+    table = hourly_table(clock, 5)
+    cache = make_cache(table)
+    df = cache.get_range('2021-11-01', '2021-11-05')
+    # both ends included, one query for the run of missing days
+    assert len(df) == 4 * 24 + 1 and len(table.queries) == 1
+    df = cache.get_range('2021-11-02', '2021-11-03')
+    assert len(table.queries) == 1
+    assert df['timestamp'].iloc[0] == ts('2021-11-02') and df['timestamp'].iloc[-1] == ts('2021-11-03')
+    assert len(df) == 25
+
+
+def test_limit_stops_reading_days(clock):
+    table = hourly_table(clock, 30, per_day=100)
+    cache = make_cache(table)
+    df = cache.get_range('2021-11-01', '2021-11-30', limit=150)
+    assert len(df) == 150
+    # 1 day then 2 days, the 27 other days are not read
+    assert [(start.day, end.day) for start, end, _ in table.queries] == [(1, 2), (2, 4)]
+    assert df['timestamp'].is_monotonic_increasing
+
+
+def test_least_recently_used_days_are_evicted(clock):
+    table = hourly_table(clock, 5)
+    one_day = make_cache(table)
+    one_day.get_range('2021-11-01', '2021-11-01')
+    cache = make_cache(table, max_bytes=int(2.5 * one_day.nbytes))
+    cache.get_range('2021-11-01', '2021-11-01')
+    cache.get_range('2021-11-02', '2021-11-02')
+    cache.get_range('2021-11-01', '2021-11-01')
+    cache.get_range('2021-11-03', '2021-11-03')
+    # 11-02 was the least recently used
+    assert [day.day for day in cache._days] == [1, 3]
+    assert cache.nbytes <= cache.max_bytes
+    queries = len(table.queries)
+    cache.get_range('2021-11-02', '2021-11-02')
+    assert len(table.queries) == queries + 1
+
+
+def test_range_larger_than_the_budget_is_not_cached(clock):
+    table = hourly_table(clock, 5)
+    cache = make_cache(table, max_bytes=1)
+    assert len(cache.get_range('2021-11-01', '2021-11-05')) == 4 * 24 + 1
+    assert cache.nbytes == 0
+
+
+def test_top_up_picks_up_late_rows_once(clock):
+    clock[0] = ts('2021-11-15 12:00')
+    table = FakeTable(clock)
+    table.add('2021-11-15 10:00')
+    table.add('2021-11-15 11:00')
+    cache = make_cache(table, late_seconds=3600)
+    assert len(cache.get_range('2021-11-15', '2021-11-16')) == 2
+    # stored an hour after its timestamp, and a new row
+    table.add('2021-11-15 11:30', stored_at='2021-11-15 12:30')
+    table.add('2021-11-15 12:45')
+    clock[0] = ts('2021-11-15 13:00')
+    cache.refresh()
+    # only the rows after the newest one cached or the late window are read again
+    assert (ts('2021-11-15'), ts('2021-11-16'), ts('2021-11-15 11:00')) in table.queries
+    df = cache.get_range('2021-11-15', '2021-11-16')
+    assert list(df['timestamp'].dt.strftime('%H:%M')) == ['10:00', '11:00', '11:30', '12:45']
+    cache.refresh()
+    assert len(cache.get_range('2021-11-15', '2021-11-16')) == 4
+
+
+def test_closed_days_are_not_read_again(clock):
+    clock[0] = ts('2021-11-15 12:00')
+    table = FakeTable(clock)
+    table.add('2021-11-14 10:00')
+    table.add('2021-11-15 10:00')
+    cache = make_cache(table, late_seconds=3600)
+    cache.get_range('2021-11-14', '2021-11-15')
+    queries = len(table.queries)
+    clock[0] = ts('2021-11-15 13:00')
+    cache.refresh()
+    # 11-14 ended more than an hour before it was read, only 11-15 is topped up
+    assert [start.day for start, _, _ in table.queries[queries:]] == [15]
@@ -0,0 +1,207 @@
+import threading
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+from lambda_.db import NULL_MARKER, ConnectionPool, _CsvStream, bulk_upsert
+
+
+def frame(rows):
+    df = pd.DataFrame(rows, columns=['author', 'timestamp', 'text', 'sentiment_score'])
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+    return df
+
+
+def test_csv_stream_renders_chunk_by_chunk():
+    df = frame([('a', f'2021-11-15 11:{i:02d}:00', f'text, {i}', i / 10) for i in range(25)])
+    stream = _CsvStream(df, chunk_rows=10)
+    pieces = iter(lambda: stream.read(7), '')
+    assert ''.join(pieces) == df.to_csv(index=False, header=False, na_rep=NULL_MARKER)
+
+
+def test_csv_stream_tells_empty_texts_from_missing_values():
+    df = frame([('a', '2021-11-15 11:00:00', '', 0.5), ('b', '2021-11-15 11:00:00', None, np.nan)])
+    assert _CsvStream(df).read().splitlines() == ['a,2021-11-15 11:00:00+00:00,,0.5',
+                                                   'b,2021-11-15 11:00:00+00:00,\\N,\\N']
+
+
+def test_rows_must_have_the_key_columns():
+    with pytest.raises(ValueError, match='no key column author'):
+        bulk_upsert(frame([]).drop(columns=['author']), None, 'tweets_analytics')
+    with pytest.raises(ValueError, match='on_conflict'):
+        bulk_upsert(frame([]), None, 'tweets_analytics', on_conflict='replace')
+
+
+@pytest.fixture
+def table(pg):
+    name = f'test_{uuid.uuid4().hex[:8]}'
+    with pg.cursor() as cur:
+        cur.execute(f"""CREATE TABLE {name}(author varchar(50), timestamp timestamp with time zone,
+                                            text varchar(300), sentiment_score double precision,
+                                            PRIMARY KEY(author, timestamp))""")
+    pg.commit()
+    yield name
+    with pg.cursor() as cur:
+        cur.execute(f'DROP TABLE {name}')
+    pg.commit()
+
+
+def stored(pg, table):
+    with pg.cursor() as cur:
+        cur.execute(f'SELECT author, text, sentiment_score FROM {table} ORDER BY author')
+        return cur.fetchall()
+
+
+def test_insert_skip_and_update(pg, table):
+    rows = [('a', '2021-11-15 11:00:00', 'one', 0.5), ('b', '2021-11-15 11:00:00', '', None)]
+    assert tuple(bulk_upsert(frame(rows), pg, table)) == (2, 0, 0)
+    assert stored(pg, table) == [('a', 'one', 0.5), ('b', '', None)]
+    # the same key twice in the batch and once in the table
+    again = [('a', '2021-11-15 11:00:00', 'changed', 0.1), ('c', '2021-11-15 11:00:00', 'three', 0.0),
+             ('c', '2021-11-15 11:00:00', 'three', 0.0)]
+    assert tuple(bulk_upsert(frame(again), pg, table)) == (1, 0, 2)
+    assert stored(pg, table)[0] == ('a', 'one', 0.5)
+    assert tuple(bulk_upsert(frame(again[:1]), pg, table, on_conflict='update')) == (0, 1, 0)
+    assert stored(pg, table)[0] == ('a', 'changed', 0.1)
+
+
+def test_failed_load_is_rolled_back(pg, table):
+    rows = [('a', '2021-11-15 11:00:00', 'x' * 301, 0.5)]
+    with pytest.raises(Exception):
+        bulk_upsert(frame(rows), pg, table)
+    assert stored(pg, table) == []
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, sql):
+        self.conn.executed.append(sql)
+        if self.conn.broken:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.in_transaction = False
+        self.executed = []
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        if self.broken:
+            raise psycopg2.InterfaceError('connection already closed')
+        self.rollbacks += 1
+        self.in_transaction = False
+
+    def get_transaction_status(self):
+        return (psycopg2.extensions.TRANSACTION_STATUS_INTRANS if self.in_transaction
+                else psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+    def close(self):
+        self.closed = 1
+
+
+class Connector:
+    def __init__(self):
+        self.connections = []
+        self.fail = False
+
+    def __call__(self):
+        if self.fail:
+            raise psycopg2.OperationalError('could not connect to server')
+        self.connections.append(FakeConnection())
+        return self.connections[-1]
+
+
+def test_pool_reuses_connections():
+    connect = Connector()
+    pool = ConnectionPool(connect, max_size=2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert second is first
+    assert len(connect.connections) == 1
+    # used recently, not checked
+    assert first.executed == []
+
+
+def test_pool_waits_for_a_free_connection_until_the_timeout():
+    pool = ConnectionPool(Connector(), max_size=1)
+    conn = pool.acquire()
+    started = time.monotonic()
+    with pytest.raises(RuntimeError, match='all 1 DB connections are in use'):
+        pool.acquire(timeout=0.05)
+    assert time.monotonic() - started >= 0.05
+    threading.Timer(0.05, pool.release, [conn]).start()
+    assert pool.acquire(timeout=5) is conn
+
+
+def test_failed_connect_frees_its_slot():
+    connect = Connector()
+    pool = ConnectionPool(connect, max_size=1)
+    connect.fail = True
+    with pytest.raises(psycopg2.OperationalError):
+        pool.acquire(timeout=0)
+    connect.fail = False
+    assert pool.acquire(timeout=0) is connect.connections[0]
+
+
+def test_idle_connections_are_checked_and_replaced_when_broken():
+    connect = Connector()
+    pool = ConnectionPool(connect, max_size=1, health_check_interval=0)
+    conn = pool.acquire()
+    pool.release(conn)
+    assert pool.acquire() is conn
+    assert conn.executed == ['SELECT 1']
+    pool.release(conn)
+    conn.broken = True
+    replacement = pool.acquire(timeout=0)
+    assert replacement is not conn and conn.closed
+    assert len(connect.connections) == 2
+
+
+def test_connection_errors_discard_the_connection():
+    connect = Connector()
+    pool = ConnectionPool(connect, max_size=1)
+    with pytest.raises(ValueError):
+        with pool.connection():
+            raise ValueError('not a connection problem')
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection() as conn:
+            assert conn is connect.connections[0]
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+    assert conn.closed
+    with pool.connection() as conn:
+        assert conn is connect.connections[1]
+
+
+def test_release_rolls_back_an_open_transaction():
+    connect = Connector()
+    pool = ConnectionPool(connect, max_size=1)
+    conn = pool.acquire()
+    conn.in_transaction = True
+    pool.release(conn)
+    assert conn.rollbacks == 1
+    assert pool.acquire(timeout=0) is conn
+    # the rollback fails: the connection is dropped
+    conn.in_transaction = conn.broken = True
+    pool.release(conn)
+    assert conn.closed
+    assert pool.acquire(timeout=0) is connect.connections[1]
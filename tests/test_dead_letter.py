@@ -0,0 +1,155 @@
+from datetime import datetime
+
+import pytest
+import pytz
+
+from conftest import BUCKET
+from lambda_ import dead_letter, pipeline
+from lambda_.archive import list_objects, read_records
+
+
+RECORDS = [{'author': 'a', 'timestamp': 1636975519.0, 'text': 'one', 'sentiment_score': 0.5},
+           {'author': 'b', 'timestamp': 1636975520.0, 'text': 'two', 'sentiment_score': -0.5}]
+
+
+@pytest.fixture(autouse=True)
+def spool_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('DEAD_LETTER_DIR', str(tmp_path))
+    return tmp_path
+
+
+def spooled_files(root):
+    return [path for path in root.rglob('*') if path.is_file()]
+
+
+def test_spool_to_s3(s3, spool_dir):
+    assert dead_letter.spool('db', 'tweets_analytics', RECORDS, BUCKET)
+    # the local copy is removed once the batch is in S3
+    assert spooled_files(spool_dir) == []
+    letters = list(dead_letter.pending(BUCKET))
+    assert [(letter.sink, letter.table_name, letter.in_s3) for letter in letters] == \
+        [('db', 'tweets_analytics', True)]
+    assert dead_letter.read(letters[0], BUCKET) == RECORDS
+    dead_letter.remove(letters[0], BUCKET)
+    assert list(dead_letter.pending(BUCKET)) == []
+
+
+def test_spool_stays_in_tmp_when_s3_fails(s3, spool_dir):
+    assert not dead_letter.spool('archive', 'guardian_posts_analytics', RECORDS, 'missing-bucket')
+    assert len(spooled_files(spool_dir)) == 1
+    dead_letter.spool('db', 'guardian_posts_analytics', RECORDS[:1], BUCKET)
+    letters = list(dead_letter.pending(BUCKET))
+    # the batches only in this container come first
+    assert [(letter.sink, letter.in_s3) for letter in letters] == [('archive', False), ('db', True)]
+    assert dead_letter.read(letters[0], BUCKET) == RECORDS
+    dead_letter.remove(letters[0], BUCKET)
+    assert spooled_files(spool_dir) == []
+
+
+def no_db():
+    raise ConnectionError('the DB is down')
+
+
+class FailingSink(pipeline.Sink):
+    name = 'db'
+
+    def write(self, rows):
+        no_db()
+
+
+def test_failing_chunks_are_spooled_and_stored_by_the_next_run(s3, monkeypatch):
+    monkeypatch.setattr(pipeline.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(pipeline, 'db_connection', no_db)
+    rows = [pipeline.convert_int_to_timestamp(record) for record in RECORDS]
+    runner = pipeline.SinkRunner(FailingSink(), 'tweets_analytics', BUCKET)
+    runner.submit(rows)
+    runner.close()
+    assert runner.dead_letters == 1 and runner.durable
+    letter, = dead_letter.pending(BUCKET)
+    assert dead_letter.read(letter, BUCKET) == RECORDS
+
+    # stored by an archive sink, which works
+    s3.copy_object(Bucket=BUCKET, CopySource={'Bucket': BUCKET, 'Key': f'dead-letter/{letter.key}'},
+                   Key=f'dead-letter/archive/tweets_analytics/{letter.key.rsplit("/", 1)[1]}')
+    assert pipeline.drain_dead_letters(BUCKET) == 1
+    # the db letter is still failing and is kept for the next run
+    assert [letter.sink for letter in dead_letter.pending(BUCKET)] == ['db']
+    key, = [obj['Key'] for obj in list_objects(BUCKET, 'raw-messages/tweets_analytics/')]
+    assert read_records(BUCKET, key) == RECORDS
+
+
+def test_chunks_only_in_tmp_are_not_durable(s3, monkeypatch):
+    monkeypatch.setattr(pipeline.time, 'sleep', lambda seconds: None)
+    rows = [dict(author='a', timestamp=datetime(2021, 11, 15, tzinfo=pytz.UTC), text='one')]
+    runner = pipeline.SinkRunner(FailingSink(), 'tweets_analytics', 'missing-bucket')
+    runner.submit(rows)
+    runner.close()
+    assert runner.dead_letters == 1 and not runner.durable
+
+
+class PickySink(pipeline.Sink):
+    '''
+    refuses the rows with a text too long, like a varchar column
+    '''
+    name = 'db'
+
+    def __init__(self, error=None):
+        self.error = error
+        self.rows = []
+
+    def write(self, rows):
+        if self.error is not None:
+            raise self.error
+        if any(len(row['text']) > 5 for row in rows):
+            raise ValueError('value too long for type character varying(5)')
+        self.rows.extend(rows)
+
+
+def drain_into(sink, monkeypatch):
+    monkeypatch.setattr(pipeline, 'make_sink', lambda name, table_name, bucket: sink)
+    return pipeline.drain_dead_letters(BUCKET)
+
+
+def test_poison_letters_are_quarantined_without_blocking_the_others(s3, monkeypatch):
+    monkeypatch.setattr(pipeline.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(dead_letter, 'MAX_ATTEMPTS', 2)
+    poison = [dict(RECORDS[0], text='much too long')]
+    dead_letter.spool('db', 'tweets_analytics', poison, BUCKET)
+    dead_letter.spool('db', 'tweets_analytics', RECORDS, BUCKET)
+
+    sink = PickySink()
+    assert drain_into(sink, monkeypatch) == 1
+    assert [row['text'] for row in sink.rows] == ['one', 'two']
+    letter, = dead_letter.pending(BUCKET)
+    assert letter.attempts == 1 and letter.key.endswith('.retry-1.json.gz')
+    assert dead_letter.read(letter, BUCKET) == poison
+
+    dead_letter.spool('db', 'tweets_analytics', RECORDS[:1], BUCKET)
+    assert drain_into(PickySink(), monkeypatch) == 1
+    assert list(dead_letter.pending(BUCKET)) == []
+    key, = [obj['Key'] for obj in list_objects(BUCKET, 'dead-letter/quarantine/')]
+    assert key.startswith('dead-letter/quarantine/db/tweets_analytics/') and 'retry' not in key
+    assert read_records(BUCKET, key) == poison
+
+
+def test_letters_wait_without_counting_while_the_sink_is_unavailable(s3, monkeypatch):
+    import psycopg2
+
+    monkeypatch.setattr(pipeline.time, 'sleep', lambda seconds: None)
+    dead_letter.spool('db', 'tweets_analytics', RECORDS, BUCKET)
+    dead_letter.spool('db', 'tweets_analytics', RECORDS, BUCKET)
+    assert drain_into(PickySink(psycopg2.OperationalError('server closed the connection')), monkeypatch) == 0
+    assert [letter.attempts for letter in dead_letter.pending(BUCKET)] == [0, 0]
+
+
+def test_local_letters_count_their_attempts(s3, spool_dir, monkeypatch):
+    monkeypatch.setattr(pipeline.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(dead_letter, 'MAX_ATTEMPTS', 2)
+    dead_letter.spool('db', 'tweets_analytics', [dict(RECORDS[0], text='much too long')], 'missing-bucket')
+    drain_into(PickySink(), monkeypatch)
+    letter, = dead_letter.pending(BUCKET)
+    assert not letter.in_s3 and letter.attempts == 1
+    drain_into(PickySink(), monkeypatch)
+    # moved to the quarantine in S3
+    assert spooled_files(spool_dir) == []
+    assert len(list(list_objects(BUCKET, 'dead-letter/quarantine/'))) == 1
@@ -0,0 +1,67 @@
+from conftest import BUCKET
+from lambda_.dedup import DedupIndex, load_index, post_hash, save_index
+
+
+def test_add_and_contains():
+    index = DedupIndex(10)
+    assert index.add('p1')
+    assert not index.add('p1')
+    assert 'p1' in index and 'p2' not in index
+    assert len(index) == 1
+
+
+def test_oldest_ids_are_forgotten_first():
+    index = DedupIndex(3)
+    for key in ['p1', 'p2', 'p3', 'p4']:
+        index.add(key)
+    assert 'p1' not in index
+    assert all(key in index for key in ['p2', 'p3', 'p4'])
+    # a forgotten id is new again
+    assert index.add('p1')
+    assert 'p2' not in index
+
+
+def test_filter_new():
+    index = DedupIndex(10)
+    index.add('p1')
+    posts = [{'id': 'p1'}, {'id': 'p2'}, {'id': 'p2'}, {'id': 'p3'}]
+    assert [post['id'] for post in index.filter_new(posts, lambda post: post['id'])] == ['p2', 'p3']
+
+
+def test_bytes_round_trip_keeps_the_order():
+    index = DedupIndex(5)
+    for i in range(7):
+        index.add(f'p{i}')
+    data = index.to_bytes()
+    assert len(data) == 5 * 8
+    loaded = DedupIndex.from_bytes(data, 5)
+    assert loaded.to_bytes() == data
+    assert all(f'p{i}' in loaded for i in range(2, 7))
+    # p2 is still the oldest one
+    loaded.add('p7')
+    assert 'p2' not in loaded and 'p3' in loaded
+
+
+def test_smaller_index_keeps_the_newest():
+    index = DedupIndex(5)
+    for i in range(5):
+        index.add(f'p{i}')
+    loaded = DedupIndex.from_bytes(index.to_bytes(), 2)
+    assert len(loaded) == 2
+    assert 'p3' in loaded and 'p4' in loaded and 'p2' not in loaded
+
+
+def test_post_hash_is_stable():
+    # the hashes are saved in S3 and read by other containers
+    assert post_hash('p1') == post_hash('p1')
+    assert post_hash('p1') != post_hash('p2')
+    assert 0 <= post_hash('p1') < 2 ** 64
+
+
+def test_saved_and_loaded_from_s3(s3):
+    assert len(load_index(BUCKET, 'guardian', 5)) == 0
+    index = DedupIndex(5)
+    index.add('p1')
+    save_index(BUCKET, 'guardian', index)
+    assert 'p1' in load_index(BUCKET, 'guardian', 5)
+    assert len(load_index(BUCKET, 'twitter', 5)) == 0
@@ -0,0 +1,133 @@
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import pytz
+import requests
+
+from lambda_.guardian_fetcher import GuardianFetcher, parse_queries
+from lambda_.watermark import Watermark
+
+
+# 130 posts, one per second from 10:00:00
+POSTS = [{'id': f'p{i:03d}', 'webPublicationDate': f'2024-06-10T10:{i // 60:02d}:{i % 60:02d}Z',
+          'webTitle': f'title {i}'} for i in range(130)]
+
+
+class GuardianStub(BaseHTTPRequestHandler):
+    '''
+    the search endpoint of the guardian api over POSTS,
+    the first `rate_limited` requests get a 429
+    '''
+    calls = []
+    rate_limited = 0
+
+    def do_GET(self):
+        params = {key: values[0] for key, values in
+                  parse_qs(urlparse(self.path).query, keep_blank_values=True).items()}
+        type(self).calls.append(params)
+        if type(self).rate_limited > 0:
+            type(self).rate_limited -= 1
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        posts = sorted(POSTS, key=lambda post: post['webPublicationDate'],
+                       reverse=params['order-by'] == 'newest')
+        if 'from-date' in params:
+            posts = [post for post in posts if post['webPublicationDate'] >= params['from-date']]
+        size, page = int(params['page-size']), int(params['page'])
+        body = json.dumps({'response': {'pages': max(1, -(-len(posts) // size)),
+                                        'results': posts[(page - 1) * size:page * size]}})
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def base_url():
+    GuardianStub.calls = []
+    GuardianStub.rate_limited = 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), GuardianStub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/search'
+    server.shutdown()
+    server.server_close()
+
+
+def make_fetcher(base_url, **kwargs):
+    return GuardianFetcher('key', base_url=base_url, page_size=50,
+                           requests_per_second=1000, burst=10, **kwargs)
+
+
+def fetch_all(fetcher, watermark, is_new):
+    posts = []
+    for name, new_posts in fetcher.fetch({'guardian': {'q': ''}}, {'guardian': watermark}, is_new):
+        assert name == 'guardian'
+        posts.extend(new_posts)
+    return posts
+
+
+def after(post_id):
+    return lambda post, watermark: post['id'] > post_id
+
+
+def test_parse_queries():
+    assert parse_queries('q=') == {'guardian': {'q': ''}}
+    assert parse_queries('q=climate, q=economy&section=business') == {
+        'guardian:q=climate': {'q': 'climate'},
+        'guardian:q=economy&section=business': {'q': 'economy', 'section': 'business'}}
+
+
+def test_without_watermark_pages_newest_first_until_an_old_post(base_url):
+    posts = fetch_all(make_fetcher(base_url), None, after('p060'))
+    assert sorted(post['id'] for post in posts) == [f'p{i:03d}' for i in range(61, 130)]
+    # page 2 reaches p060, page 3 is not requested
+    assert [call['page'] for call in GuardianStub.calls] == ['1', '2']
+    assert {call['order-by'] for call in GuardianStub.calls} == {'newest'}
+    assert all('from-date' not in call for call in GuardianStub.calls)
+
+
+def test_without_watermark_every_page_is_read_when_all_posts_are_new(base_url):
+    posts = fetch_all(make_fetcher(base_url), None, lambda post, watermark: True)
+    assert len(posts) == len(POSTS)
+    assert sorted(call['page'] for call in GuardianStub.calls) == ['1', '2', '3']
+
+
+def test_with_watermark_pages_oldest_first_from_the_watermark(base_url):
+    watermark = Watermark(datetime(2024, 6, 10, 10, 0, 20, tzinfo=pytz.UTC), 'p020')
+    posts = fetch_all(make_fetcher(base_url), watermark, after('p020'))
+    assert sorted(post['id'] for post in posts) == [f'p{i:03d}' for i in range(21, 130)]
+    # 110 posts from the watermark included: page 1 then pages 2 and 3 at once
+    assert sorted(call['page'] for call in GuardianStub.calls) == ['1', '2', '3']
+    assert {call['order-by'] for call in GuardianStub.calls} == {'oldest'}
+    assert {call['from-date'] for call in GuardianStub.calls} == {'2024-06-10T10:00:20Z'}
+
+
+def test_max_pages(base_url):
+    posts = fetch_all(make_fetcher(base_url, max_pages=2), None, lambda post, watermark: True)
+    assert len(posts) == 100
+
+
+def test_rate_limited_requests_are_retried(base_url):
+    GuardianStub.rate_limited = 2
+    page = make_fetcher(base_url).get_page('guardian', {'q': ''}, 1, None)
+    assert len(page.posts) == 50 and page.total_pages == 3
+    assert len(GuardianStub.calls) == 3
+
+
+def test_rate_limited_too_many_times(base_url):
+    GuardianStub.rate_limited = 3
+    with pytest.raises(requests.HTTPError):
+        make_fetcher(base_url, max_retries=2).get_page('guardian', {'q': ''}, 1, None)
+    assert len(GuardianStub.calls) == 3
@@ -0,0 +1,54 @@
+from datetime import datetime
+
+import pytz
+
+from lambda_.lambda_function import extract_fields, fetch_new_tweets
+from lambda_.watermark import Watermark
+
+
+def make_tweet(tweet_id):
+    return {'id_str': str(tweet_id), 'created_at': 'Sat Sep 02 14:25:02 +0000 2021',
+            'text': f'tweet {tweet_id}', 'user': {'screen_name': 'reuters'}}
+
+
+class FakeTimeline:
+    '''
+    user timeline of tweets 1 to 100 newest first, a page drops its retweets
+    (every 3rd id) after counting them like the twitter api
+    '''
+
+    def __init__(self):
+        self.queries = []
+
+    def get_user_timeline(self, screen_name, count, since_id=None, max_id=None):
+        self.queries.append(dict(since_id=since_id, max_id=max_id))
+        ids = [tweet_id for tweet_id in range(100, 0, -1)
+               if (since_id is None or tweet_id > int(since_id))
+               and (max_id is None or tweet_id <= max_id)][:count]
+        return [make_tweet(tweet_id) for tweet_id in ids if tweet_id % 3]
+
+
+WATERMARK = Watermark(datetime(2021, 9, 2, tzinfo=pytz.UTC), '40')
+
+
+def test_pages_back_to_the_watermark_through_short_pages():
+    timeline = FakeTimeline()
+    pages = list(fetch_new_tweets(timeline, 'reuters', WATERMARK, page_size=20))
+    ids = [int(tweet['id_str']) for page in pages for tweet in page]
+    assert ids == [tweet_id for tweet_id in range(100, 40, -1) if tweet_id % 3]
+    assert all(len(page) < 20 for page in pages)
+    # the last request gives an empty page
+    assert len(timeline.queries) == len(pages) + 1
+    assert {query['since_id'] for query in timeline.queries} == {'40'}
+
+
+def test_without_watermark_only_the_newest_page():
+    timeline = FakeTimeline()
+    pages = list(fetch_new_tweets(timeline, 'reuters', None, page_size=20))
+    assert len(pages) == 1 and len(timeline.queries) == 1
+
+
+def test_extract_fields():
+    row = extract_fields(make_tweet(7))
+    assert row == dict(author='reuters', timestamp=datetime(2021, 9, 2, 14, 25, 2, tzinfo=pytz.UTC),
+                       text='tweet 7', post_id='7')
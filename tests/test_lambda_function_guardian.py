@@ -0,0 +1,20 @@
+from datetime import datetime
+
+import pytz
+
+from lambda_.lambda_function_guardian import extract_fields, post_author
+
+
+def test_posts_of_the_same_second_have_different_keys():
+    posts = [{'id': f'politics/2024/jun/10/a-very-long-slug-of-the-article-number-{i}',
+              'webPublicationDate': '2024-06-10T10:46:19Z', 'webTitle': f'title {i}'} for i in range(2)]
+    rows = [extract_fields(post) for post in posts]
+    assert rows[0]['timestamp'] == rows[1]['timestamp'] == datetime(2024, 6, 10, 10, 46, 19, tzinfo=pytz.UTC)
+    assert rows[0]['author'] != rows[1]['author']
+    assert all(row['author'].startswith('guardian:') and len(row['author']) <= 50 for row in rows)
+    assert rows[0]['post_id'] == posts[0]['id']
+
+
+def test_post_author_is_stable():
+    # the archive replays and the fetches of later runs must give the same key
+    assert post_author('world/2024/jun/10/x') == post_author('world/2024/jun/10/x')
@@ -0,0 +1,123 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+from lambda_ import pipeline
+from lambda_.sentiment import VERSION_COLUMN, SentimentEngine
+
+
+START = datetime(2021, 11, 15, 11, tzinfo=pytz.UTC)
+
+
+class FakeAnalyzer:
+    lexicon = {'good': 1.9}
+
+    def polarity_scores(self, text):
+        pos = 1.0 if 'good' in text else 0.0
+        return {'neg': 1.0 - pos, 'neu': 0.0, 'pos': pos, 'compound': 2 * pos - 1}
+
+
+class FakeSource(pipeline.Source):
+    name = 'fake'
+    table_name = 'fake_analytics'
+
+    def __init__(self, posts, fail_after=None):
+        self._posts = posts
+        self.fail_after = fail_after
+        self.opened = self.committed = False
+
+    def open(self, conn):
+        self.opened = True
+
+    def posts(self):
+        for i, post in enumerate(self._posts):
+            if i == self.fail_after:
+                raise RuntimeError('the API went away')
+            yield post
+
+    def extract(self, post):
+        return dict(author='fake', timestamp=START + timedelta(seconds=post['n']),
+                    text=post['title'], post_id=post['id'])
+
+    def post_key(self, post):
+        return post['id']
+
+    def commit(self, conn):
+        self.committed = True
+
+
+class ListSink(pipeline.Sink):
+    name = 'list'
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, rows):
+        self.chunks.append(rows)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    @contextmanager
+    def no_db():
+        yield None
+
+    monkeypatch.setattr(pipeline, 'db_connection', no_db)
+    monkeypatch.setattr(pipeline, 'engine', SentimentEngine(FakeAnalyzer()))
+
+
+def make_posts(n):
+    return [{'id': f'p{i}', 'n': i, 'title': 'good news' if i % 2 else 'sad news'} for i in range(n)]
+
+
+def test_chunked():
+    assert list(pipeline.chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(pipeline.chunked([], 2)) == []
+
+
+def test_every_sink_gets_every_scored_chunk():
+    source = FakeSource(make_posts(5))
+    sinks = [ListSink(), ListSink()]
+    result = pipeline.run_pipeline(source, sinks, chunk_size=2, bucket='unused', dedup_size=0)
+    assert result == pipeline.PipelineResult('fake', 5, 3, 0)
+    assert source.opened and source.committed
+    for sink in sinks:
+        assert sink.closed
+        assert [len(chunk) for chunk in sink.chunks] == [2, 2, 1]
+        rows = [row for chunk in sink.chunks for row in chunk]
+        assert [row['post_id'] for row in rows] == [f'p{i}' for i in range(5)]
+        assert [row['sentiment_score'] for row in rows] == [-1.0, 1.0, -1.0, 1.0, -1.0]
+        assert {row[VERSION_COLUMN] for row in rows} == {pipeline.engine.version}
+
+
+def test_no_new_posts():
+    source = FakeSource([])
+    sink = ListSink()
+    assert pipeline.run_pipeline(source, [sink], bucket='unused', dedup_size=0) == \
+        pipeline.PipelineResult('fake', 0, 0, 0)
+    assert sink.chunks == [] and sink.closed
+    # the position can move even without rows
+    assert source.committed
+
+
+def test_fetch_failure_keeps_the_chunks_already_read_and_the_position():
+    source = FakeSource(make_posts(5), fail_after=3)
+    sink = ListSink()
+    with pytest.raises(RuntimeError):
+        pipeline.run_pipeline(source, [sink], chunk_size=2, bucket='unused', dedup_size=0)
+    assert [[row['post_id'] for row in chunk] for chunk in sink.chunks] == [['p0', 'p1']]
+    assert sink.closed
+    assert not source.committed
+
+
+def test_archive_records_are_json():
+    row = dict(author='fake', timestamp=START, text='good', sentiment_score=1.0)
+    record = pipeline.convert_timestamp_to_int(row)
+    assert record['timestamp'] == START.timestamp() and row['timestamp'] == START
+    assert pipeline.convert_int_to_timestamp(record) == row
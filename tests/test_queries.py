@@ -0,0 +1,100 @@
+import re
+import uuid
+
+import pytest
+
+from lambda_.search import search_condition
+from queries import build_page_query, build_query, where_clause
+
+
+def flat(sql):
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def test_where_clause():
+    assert where_clause('2021-11-01', '2021-11-30') == (
+        'where timestamp between date(%s) and date(%s)', ['2021-11-01', '2021-11-30'])
+    sql, params = where_clause('2021-11-01', '2021-11-30', 'Climate chan')
+    assert sql.endswith(f' and {search_condition()}')
+    assert params == ['2021-11-01', '2021-11-30', 'climate:* & chan:*']
+    # a keyword without words is no filter
+    assert where_clause('2021-11-01', '2021-11-30', ' !? ')[1] == ['2021-11-01', '2021-11-30']
+
+
+def test_build_query():
+    sql, params = build_query('2021-11-01', '2021-11-30', limit=100, offset=200)
+    assert flat(sql) == ('select timestamp, sentiment_score, text from tweets_analytics '
+                         'where timestamp between date(%s) and date(%s) order by timestamp limit %s offset %s')
+    assert params == ['2021-11-01', '2021-11-30', 100, 200]
+    assert 'limit' not in build_query('2021-11-01', '2021-11-30')[0]
+
+
+def test_first_page_newest_first():
+    sql, params = build_page_query('2021-11-01', '2021-11-30', page_size=50)
+    assert flat(sql) == ('select timestamp, sentiment_score, text, author from tweets_analytics '
+                         'where timestamp between date(%s) and date(%s) '
+                         'order by timestamp desc, author desc limit %s')
+    # one more row than the page tells if there is a next page
+    assert params == ['2021-11-01', '2021-11-30', 51]
+
+
+def test_next_page_newest_first():
+    sql, params = build_page_query('2021-11-01', '2021-11-30', page_size=50,
+                                   after=('2021-11-15 11:25:19+00', 'reuters'))
+    assert flat(sql).endswith('where timestamp between date(%s) and date(%s) '
+                              'and timestamp <= %s and (timestamp < %s or author < %s) '
+                              'order by timestamp desc, author desc limit %s')
+    assert params == ['2021-11-01', '2021-11-30', '2021-11-15 11:25:19+00', '2021-11-15 11:25:19+00',
+                      'reuters', 51]
+
+
+def test_next_page_oldest_first_with_a_keyword():
+    sql, params = build_page_query('2021-11-01', '2021-11-30', keyword='climate', page_size=10,
+                                   after=('2021-11-15 11:25:19+00', 'reuters'), descending=False,
+                                   table_name='guardian_posts_analytics')
+    assert flat(sql) == ('select timestamp, sentiment_score, text, author from guardian_posts_analytics '
+                         f'where timestamp between date(%s) and date(%s) and {search_condition()} '
+                         'and timestamp >= %s and (timestamp > %s or author > %s) '
+                         'order by timestamp asc, author asc limit %s')
+    # the parameters follow the placeholders
+    assert params == ['2021-11-01', '2021-11-30', 'climate:*', '2021-11-15 11:25:19+00',
+                      '2021-11-15 11:25:19+00', 'reuters', 11]
+    assert flat(sql).count('%s') == len(params)
+
+
+@pytest.fixture
+def table(pg):
+    name = f'test_{uuid.uuid4().hex[:8]}'
+    with pg.cursor() as cur:
+        cur.execute(f"""CREATE TABLE {name}(author varchar(50), timestamp timestamp with time zone,
+                                            text varchar(300), sentiment_score double precision,
+                                            PRIMARY KEY(author, timestamp))""")
+        # 3 authors posting in the same seconds, and rows on both ends of the range
+        cur.execute(f"""INSERT INTO {name}
+                        SELECT author, timestamptz '2021-11-01 00:00+00' + i * interval '6 hours', 't', 0
+                        FROM generate_series(0, 8) i, unnest(array['a', 'b', 'c']) author""")
+    pg.commit()
+    yield name
+    with pg.cursor() as cur:
+        cur.execute(f'DROP TABLE {name}')
+    pg.commit()
+
+
+@pytest.mark.parametrize('descending', [True, False])
+def test_pages_walk_every_row_once(pg, table, descending):
+    with pg.cursor() as cur:
+        cur.execute("SET timezone = 'UTC'")
+        cur.execute(f"SELECT timestamp, author FROM {table} WHERE timestamp BETWEEN '2021-11-01' AND '2021-11-02' "
+                    f"ORDER BY timestamp {'desc' if descending else 'asc'}, author {'desc' if descending else 'asc'}")
+        expected = cur.fetchall()
+        seen, after = [], None
+        while True:
+            sql, params = build_page_query('2021-11-01', '2021-11-02', page_size=4, after=after,
+                                           descending=descending, table_name=table)
+            cur.execute(sql, params)
+            rows = [(row[0], row[3]) for row in cur.fetchall()]
+            seen += rows[:4]
+            if len(rows) <= 4:
+                break
+            after = rows[3]
+    assert seen == expected and len(expected) == 15
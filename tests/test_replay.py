@@ -0,0 +1,130 @@
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+import json
+
+import pytest
+import pytz
+
+from conftest import BUCKET
+from lambda_ import replay
+from lambda_.archive import serialize_records, table_prefix, upload_records
+from lambda_.db import LoadResult
+
+
+TWEET = {'author': 'reuters', 'text': 'a tweet', 'sentiment_score': 0.5}
+GUARDIAN_POST = {'author': None, 'text': 'a post', 'sentiment_score': -0.5}
+
+
+def record(base, when, **fields):
+    return dict(base, timestamp=when.timestamp(), **fields)
+
+
+@pytest.fixture
+def loaded(monkeypatch):
+    '''
+    the rows given to the bulk loader, no DB needed
+    '''
+    frames = []
+
+    @contextmanager
+    def no_db():
+        yield None
+
+    def fake_upsert(df, conn, table_name, on_conflict):
+        frames.append((table_name, df))
+        return LoadResult(len(df), 0, 0)
+
+    monkeypatch.setattr(replay, 'db_connection', no_db)
+    monkeypatch.setattr(replay, 'bulk_upsert', fake_upsert)
+    return frames
+
+
+def archive_days(days, table_name='tweets_analytics'):
+    for day in days:
+        when = datetime(2021, 11, day, 11, 25, 19, tzinfo=pytz.UTC)
+        for i in range(3):
+            upload_records([record(TWEET, when + timedelta(minutes=i), text=f'tweet {day} {i}')],
+                           BUCKET, prefix=table_prefix(table_name), now=when + timedelta(minutes=i))
+
+
+def texts(frames):
+    return sorted(text for _, df in frames for text in df['text'])
+
+
+def run(tmp_path, start, end, **kwargs):
+    return replay.replay(BUCKET, 'tweets_analytics', date(2021, 11, start), date(2021, 11, end),
+                         checkpoint_path=str(tmp_path / 'replay.json'), workers=2, **kwargs)
+
+
+def test_legacy_table():
+    assert replay.legacy_table(TWEET) == 'tweets_analytics'
+    assert replay.legacy_table(GUARDIAN_POST) == 'guardian_posts_analytics'
+    assert replay.legacy_table({'text': 'no author'}) == 'guardian_posts_analytics'
+
+
+def test_skip_done():
+    assert list(replay._skip_done(iter('abc'), None)) == ['a', 'b', 'c']
+    assert list(replay._skip_done(iter('abc'), 'b')) == ['c']
+    assert list(replay._skip_done(iter('abc'), 'c')) == []
+    with pytest.raises(ValueError):
+        list(replay._skip_done(iter('abc'), 'x'))
+
+
+def test_legacy_objects_are_split_by_table(s3, loaded, tmp_path):
+    when = datetime(2021, 11, 1, 11, tzinfo=pytz.UTC)
+    mixed = [record(TWEET, when), record(GUARDIAN_POST, when)]
+    s3.put_object(Bucket=BUCKET, Key='raw-messages/01-11-2021-11:00:00.json', Body=json.dumps(mixed))
+    s3.put_object(Bucket=BUCKET, Key='raw-messages/dt=2021-11-01/hour=11/110000-1.json.gz',
+                  Body=serialize_records(mixed).getvalue())
+    archive_days([1])
+    run(tmp_path, 1, 1)
+    assert texts(loaded) == ['a tweet', 'a tweet', 'tweet 1 0', 'tweet 1 1', 'tweet 1 2']
+    loaded.clear()
+    replay.replay(BUCKET, 'guardian_posts_analytics', date(2021, 11, 1), date(2021, 11, 1),
+                  checkpoint_path=str(tmp_path / 'guardian.json'))
+    df = loaded[0][1]
+    assert list(df['text']) == ['a post', 'a post']
+    assert set(df['author']) == {'guardian'}
+
+
+def test_resume_after_an_interruption(s3, loaded, tmp_path, monkeypatch):
+    archive_days([1, 2])
+    fake_upsert = replay.bulk_upsert
+    failing = [True]
+
+    def interrupted(df, conn, table_name, on_conflict):
+        if failing[0] and len(loaded) == 2:
+            raise ConnectionError('the DB went away')
+        return fake_upsert(df, conn, table_name, on_conflict)
+
+    monkeypatch.setattr(replay, 'bulk_upsert', interrupted)
+    with pytest.raises(ConnectionError):
+        run(tmp_path, 1, 2, batch_rows=2)
+    assert texts(loaded) == ['tweet 1 0', 'tweet 1 1', 'tweet 1 2', 'tweet 2 0']
+    loaded.clear()
+    failing[0] = False
+    run(tmp_path, 1, 2, batch_rows=2)
+    assert texts(loaded) == ['tweet 2 1', 'tweet 2 2']
+
+
+def test_another_range_starts_over(s3, loaded, tmp_path):
+    archive_days([1, 2, 3])
+    run(tmp_path, 1, 1)
+    assert texts(loaded) == ['tweet 1 0', 'tweet 1 1', 'tweet 1 2']
+    loaded.clear()
+    # the checkpoint of the first range is ignored
+    assert run(tmp_path, 2, 3).inserted == 6
+    # the same range again resumes after its last key, nothing is left
+    loaded.clear()
+    assert run(tmp_path, 2, 3).inserted == 0
+    assert loaded == []
+
+
+def test_missing_checkpoint_key(s3, loaded, tmp_path):
+    archive_days([1])
+    run(tmp_path, 1, 1)
+    for obj in s3.list_objects_v2(Bucket=BUCKET)['Contents']:
+        s3.delete_object(Bucket=BUCKET, Key=obj['Key'])
+    archive_days([1])
+    with pytest.raises(ValueError):
+        run(tmp_path, 1, 1)
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+import pytz
+
+from lambda_.rollups import choose_resolution, downsample
+
+
+START = datetime(2021, 11, 15, tzinfo=pytz.UTC)
+
+
+def buckets(counts, scores):
+    # one minute bucket per count, every post of a bucket has its score
+    return pd.DataFrame({'bucket': [START + timedelta(minutes=i) for i in range(len(counts))],
+                         'n': counts,
+                         'sum_score': [n * score for n, score in zip(counts, scores)],
+                         'min_score': [score - 0.1 for score in scores],
+                         'max_score': [score + 0.1 for score in scores]})
+
+
+def test_choose_resolution_boundaries():
+    assert choose_resolution(START, START + timedelta(minutes=500), 500) == 'minute'
+    assert choose_resolution(START, START + timedelta(minutes=501), 500) == 'hour'
+    assert choose_resolution(START, START + timedelta(hours=500), 500) == 'hour'
+    assert choose_resolution(START, START + timedelta(hours=501), 500) == 'day'
+    # the coarsest one even when it gives too many buckets
+    assert choose_resolution(START, START + timedelta(days=501), 500) == 'day'
+
+
+def test_downsample_empty():
+    empty = buckets([], [])
+    df = downsample(empty, 10)
+    assert len(df) == 0
+    assert str(df.index.tz) == 'UTC'
+    assert list(df.columns) == ['count', 'sentiment_score', 'min', 'max']
+
+
+def test_downsample_keeps_few_buckets():
+    df = downsample(buckets([1, 2], [0.5, -0.5]), 10)
+    assert list(df['count']) == [1, 2]
+    assert list(df['sentiment_score']) == pytest.approx([0.5, -0.5])
+    assert df.index[0] == START and str(df.index.tz) == 'UTC'
+
+
+def test_downsample_weights_the_mean_by_the_counts():
+    df = downsample(buckets([1, 3, 2, 2], [1.0, 0.0, 0.5, -0.5]), 2)
+    assert list(df.index) == [START, START + timedelta(minutes=2)]
+    assert list(df['count']) == [4, 4]
+    # (1 * 1.0 + 3 * 0.0) / 4, not the mean of the two means
+    assert list(df['sentiment_score']) == pytest.approx([0.25, 0.0])
+    assert list(df['min']) == pytest.approx([-0.1, -0.6])
+    assert list(df['max']) == pytest.approx([1.1, 0.6])
+
+
+@pytest.mark.parametrize('length, max_points', [(1000, 500), (1001, 500), (7, 3), (10, 1)])
+def test_downsample_bound(length, max_points):
+    df = downsample(buckets([1] * length, [0.0] * length), max_points)
+    assert len(df) == max_points
+    assert df['count'].sum() == length
+    assert df.index.is_monotonic_increasing
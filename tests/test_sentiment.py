@@ -0,0 +1,70 @@
+import pytest
+
+from lambda_.sentiment import SentimentEngine, normalize_text
+
+
+class FakeAnalyzer:
+    '''
+    positive for 'good', negative for 'bad', counts the texts scored
+    '''
+
+    def __init__(self):
+        self.lexicon = {'good': 1.9, 'bad': -2.5}
+        self.calls = []
+
+    def polarity_scores(self, text):
+        self.calls.append(text)
+        words = text.lower().split()
+        pos = sum(word == 'good' for word in words) / len(words)
+        neg = sum(word == 'bad' for word in words) / len(words)
+        return {'neg': neg, 'neu': 1 - pos - neg, 'pos': pos, 'compound': pos - neg}
+
+
+def test_score_is_positive_minus_negative():
+    engine = SentimentEngine(FakeAnalyzer())
+    assert engine.score('good day') == pytest.approx(0.5)
+    assert engine.score('bad bad day good') == pytest.approx(-0.25)
+
+
+def test_repeated_texts_are_scored_once():
+    analyzer = FakeAnalyzer()
+    engine = SentimentEngine(analyzer)
+    scores = engine.score_many(['good news', 'good  news ', 'bad news', 'good news'])
+    assert list(scores) == pytest.approx([0.5, 0.5, -0.5, 0.5])
+    assert analyzer.calls == ['good news', 'bad news']
+    assert (engine.hits, engine.misses) == (2, 2)
+    engine.score('bad   news')
+    assert analyzer.calls == ['good news', 'bad news']
+    assert engine.stats() == dict(hits=3, misses=2, hit_rate=0.6, cache_size=2)
+
+
+def test_least_recently_used_scores_are_evicted():
+    analyzer = FakeAnalyzer()
+    engine = SentimentEngine(analyzer, max_size=2)
+    engine.score_many(['a good', 'b good'])
+    # 'a' is used again so 'b' is the least recently used
+    engine.score('a good')
+    engine.score('c bad')
+    assert engine.stats()['cache_size'] == 2
+    analyzer.calls.clear()
+    engine.score_many(['a good', 'c bad', 'b good'])
+    assert analyzer.calls == ['b good']
+
+
+def test_clear():
+    engine = SentimentEngine(FakeAnalyzer())
+    engine.score('good')
+    engine.clear()
+    assert engine.stats() == dict(hits=0, misses=0, hit_rate=0.0, cache_size=0)
+
+
+def test_version_depends_on_the_lexicon():
+    analyzer = FakeAnalyzer()
+    version = SentimentEngine(analyzer).version
+    assert version.startswith('vader-')
+    analyzer.lexicon['great'] = 3.1
+    assert SentimentEngine(analyzer).version != version
+
+
+def test_normalize_text_keeps_the_case():
+    assert normalize_text('  GOOD\tnews \n today ') == 'GOOD news today'
@@ -0,0 +1,48 @@
+from datetime import datetime
+
+import pytz
+
+from lambda_.timestamps import (PARSED_KEY, TWITTER_FORMAT, parse_guardian_time, parse_times,
+                                parse_twitter_time, post_time)
+
+
+def test_parse_guardian_time():
+    assert parse_guardian_time('2024-06-10T10:46:19Z') == datetime(2024, 6, 10, 10, 46, 19, tzinfo=pytz.UTC)
+
+
+def test_parse_twitter_time():
+    assert parse_twitter_time('Sat Sep 02 14:25:02 +0000 2021') == \
+        datetime(2021, 9, 2, 14, 25, 2, tzinfo=pytz.UTC)
+
+
+def test_other_formats_go_through_dateutil():
+    expected = datetime(2024, 6, 10, 10, 46, 19, tzinfo=pytz.UTC)
+    assert parse_guardian_time('2024-06-10T12:46:19+02:00') == expected
+    assert parse_guardian_time('2024-06-10T10:46:19') == expected
+    assert parse_twitter_time('Mon Jun 10 12:46:19 +0200 2024') == expected
+    # fractions of a second
+    assert parse_guardian_time('2024-06-10T10:46:19.5Z') == expected.replace(microsecond=500000)
+
+
+def test_post_time_parses_once():
+    calls = []
+
+    def parse(value):
+        calls.append(value)
+        return parse_guardian_time(value)
+
+    post = {'webPublicationDate': '2024-06-10T10:46:19Z'}
+    first = post_time(post, 'webPublicationDate', parse)
+    assert post_time(post, 'webPublicationDate', parse) is first
+    assert post[PARSED_KEY] == first
+    assert calls == ['2024-06-10T10:46:19Z']
+
+
+def test_parse_times():
+    parsed = parse_times(['2024-06-10T10:46:19Z', '2024-06-10T12:46:20+02:00', None])
+    assert list(parsed[:2]) == [datetime(2024, 6, 10, 10, 46, 19, tzinfo=pytz.UTC),
+                                datetime(2024, 6, 10, 10, 46, 20, tzinfo=pytz.UTC)]
+    assert parsed.isna().tolist() == [False, False, True]
+    assert str(parsed.dt.tz) == 'UTC'
+    parsed = parse_times(['Sat Sep 02 14:25:02 +0000 2021'], TWITTER_FORMAT)
+    assert parsed[0] == datetime(2021, 9, 2, 14, 25, 2, tzinfo=pytz.UTC)